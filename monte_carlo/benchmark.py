@@ -0,0 +1,94 @@
+import sys
+import numpy as np
+from timeit import default_timer as timer
+from scipy.signal import correlate2d
+from ising import NeighborSum,MH_sampling,acceptance_table,spinMH
+from ising_numba import numba_flag
+
+
+################################################
+#                                              #
+#       Benchmark of the neighbor sums         #
+#                                              #
+################################################
+
+
+def _window(k):
+    """
+    k x k window of ones without the center
+    """
+    window = np.ones((k,k),dtype=int)
+    window[k//2,k//2] = 0
+    return window
+
+
+def bench_neighbor(state,window,method,repeat):
+    """
+    Milliseconds per call of NeighborSum, method None is correlate2d as in energy
+    """
+    if method is None:
+        call = lambda: correlate2d(state,window,mode='same')
+    else:
+        neighbor = NeighborSum(state.shape,window,method=method)
+        call = lambda: neighbor(state)
+    call()
+    start = timer()
+    for i in range(repeat):
+        call()
+    return 1e3*(timer()-start)/repeat
+
+
+def bench_sampling(state,window,method,repeat,j=1,h=0,beta=0.4):
+    """
+    Milliseconds per iteration of MH_sampling, method None is correlate2d
+    """
+    table = acceptance_table(j,h,beta,window)
+    neighbor = None if method is None else NeighborSum(state.shape,window,method=method)
+    new_state = state
+    start = timer()
+    for i in range(repeat):
+        new_state = MH_sampling(new_state,j,h,beta,window,table,neighbor)
+    return 1e3*(timer()-start)/repeat
+
+
+def bench_method(size,method,repeat,beta=0.4):
+    """
+    Milliseconds per sweep of spinMH with the 3x3 window and the periodic boundary,
+    except the sync update with the zero boundary as before
+    """
+    boundary = 'zero' if method == 'sync' else 'periodic'
+    # warm up, the numba kernel is compiled in the first call
+    spinMH(size=[size,size],beta=beta,iters=1,seed=0,method=method,boundary=boundary)
+    start = timer()
+    spinMH(size=[size,size],beta=beta,iters=repeat,seed=0,method=method,boundary=boundary)
+    return 1e3*(timer()-start)/repeat
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    np.random.seed(0)
+    state = np.random.choice([1,-1],size=(size,size))
+    print('%dx%d grid, neighbor sums [ms]'%(size,size))
+    print('%8s %8s %12s %10s %10s %10s'%('window','weights','correlate2d','slice','fft','auto'))
+    for k in [3,5,7,9,11,15,21]:
+        window = _window(k)
+        # the direct correlation is too slow to be measured for large windows
+        t_direct = bench_neighbor(state,window,None,1) if k <= 11 else np.nan
+        t_slice = bench_neighbor(state,window,'slice',repeat)
+        t_fft = bench_neighbor(state,window,'fft',repeat)
+        t_auto = bench_neighbor(state,window,'auto',repeat)
+        print('%8s %8d %12.1f %10.1f %10.1f %10.1f'%('%dx%d'%(k,k),np.count_nonzero(window),
+                                                    t_direct,t_slice,t_fft,t_auto))
+    
+    print('%dx%d grid, MH_sampling with the 3x3 window [ms]'%(size,size))
+    t_old = bench_sampling(state,_window(3),None,repeat)
+    t_new = bench_sampling(state,_window(3),'auto',repeat)
+    print('correlate2d %.1f, auto %.1f, %.1fx'%(t_old,t_new,t_old/t_new))
+    
+    # the multispin sweep needs a number of columns that is a multiple of 64
+    size = 64*max(1,size//64)
+    print('%dx%d grid, sweeps of spinMH [ms], numba available: %s'%(size,size,numba_flag))
+    print('%12s %10s'%('method','[ms]'))
+    for method in ['sync','checkerboard','multispin','sequential']:
+        print('%12s %10.1f'%(method,bench_method(size,method,repeat)))
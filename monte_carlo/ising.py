@@ -1,10 +1,147 @@
+import warnings
+from functools import lru_cache
 import numpy as np
 from scipy.signal import correlate2d
+from scipy.fft import rfft2,irfft2,next_fast_len
+from scipy.special import expit
 
 
 gpu_flag = False
 
-def energy(state,j,h,window):
+# 'auto' sums the shifted slices up to this number of nonzero weights in the window
+# and uses the FFT above, see benchmark.py
+_slice_max = 120
+
+
+def _wrap_border(padded,size_y,size_x,ry,rx):
+    """
+    Fill the border of the half-sizes (ry,rx) around the grid padded[ry:ry+size_y,rx:rx+size_x]
+    with the spins of the opposite edges, the periodic boundary
+    """
+    padded[:ry,rx:rx+size_x] = padded[size_y:size_y+ry,rx:rx+size_x]
+    padded[ry+size_y:ry+size_y+ry,rx:rx+size_x] = padded[ry:2*ry,rx:rx+size_x]
+    padded[:size_y+2*ry,:rx] = padded[:size_y+2*ry,size_x:size_x+rx]
+    padded[:size_y+2*ry,rx+size_x:rx+size_x+rx] = padded[:size_y+2*ry,rx:2*rx]
+
+
+class NeighborSum:
+    """
+    Sums of neighborhood spins of a grid of fixed size, the same as
+    correlate2d(state,window,mode='same') for the zero boundary. The buffers are
+    allocated once and reused by every call
+    
+    Input
+    ------
+    size: the size of the grid
+    window: a 2D window with how many neighbors should
+        be considered to calculate the spin sum
+    method: 'slice' adds the shifted slices of the state for each nonzero weight
+                of the window into an int8 or int16 buffer, for small windows
+            'fft' correlates with the FFT of the window, for large windows
+            'direct' is correlate2d
+            'auto' picks 'slice' for at most _slice_max nonzero weights and 'fft'
+                otherwise, 'direct' for windows with even sizes
+    boundary: 'zero' for no spins outside the grid
+              'periodic' for the grid wrapped around, the window should not
+                  be larger than the grid
+    """
+    
+    def __init__(self,size,window,method='auto',boundary='zero'):
+        window = np.asarray(window)
+        odd = window.shape[0] % 2 == 1 and window.shape[1] % 2 == 1
+        if method == 'auto':
+            if not odd:
+                method = 'direct'
+            elif np.count_nonzero(window) <= _slice_max:
+                method = 'slice'
+            else:
+                method = 'fft'
+        elif method not in ('slice','fft','direct'):
+            raise ValueError('method should be \'auto\', \'slice\', \'fft\' or \'direct\'')
+        elif method != 'direct' and not odd:
+            raise ValueError('The window should have odd sizes for method \''+method+'\'')
+        else: pass
+        if boundary not in ('zero','periodic'):
+            raise ValueError('boundary should be \'zero\' or \'periodic\'')
+        elif boundary == 'periodic' and (window.shape[0] > size[0] or window.shape[1] > size[1]):
+            raise ValueError('The window should not be larger than the grid for the periodic boundary')
+        else: pass
+        self.size = (size[0],size[1])
+        self.window = window
+        self.method = method
+        self.boundary = boundary
+        self.ry,self.rx = window.shape[0]//2,window.shape[1]//2
+        
+        # the sums of an integer window are integers, the smallest integer type holding
+        # the sums and the table indices, see acceptance_table, is enough
+        if window.dtype.kind in 'iu':
+            max_sum = int(np.abs(window).sum())
+            if 2*max_sum <= np.iinfo(np.int8).max:
+                dtype = np.int8
+            elif 2*max_sum <= np.iinfo(np.int16).max:
+                dtype = np.int16
+            else:
+                dtype = np.int64
+        else:
+            dtype = np.float64
+        self.out = np.empty(self.size,dtype=dtype)
+        
+        shape = (self.size[0]+2*self.ry,self.size[1]+2*self.rx)
+        if method == 'slice':
+            self._padded = np.zeros(shape,dtype=dtype)
+            self._terms = [(u,v,window[u,v]) for u,v in zip(*np.nonzero(window))]
+        elif method == 'fft':
+            # the circular correlation of the padded grid does not wrap around
+            # for the sites of the grid
+            shape = (next_fast_len(shape[0],True),next_fast_len(shape[1],True))
+            self._padded = np.zeros(shape)
+            kernel = np.zeros(shape)
+            kernel[:window.shape[0],:window.shape[1]] = window
+            self._kernel = np.conj(rfft2(kernel))
+        else: pass
+    
+    def __call__(self,state):
+        """
+        The sums of neighborhood spins of state, the returned array is the buffer
+        overwritten by the next call
+        """
+        size_y,size_x = self.size
+        ry,rx = self.ry,self.rx
+        if self.method == 'direct':
+            if self.boundary == 'periodic':
+                self.out[:] = correlate2d(state,self.window,mode='same',boundary='wrap')
+            else:
+                self.out[:] = correlate2d(state,self.window,mode='same')
+            return self.out
+        else: pass
+        
+        padded = self._padded
+        padded[ry:ry+size_y,rx:rx+size_x] = state
+        if self.boundary == 'periodic':
+            _wrap_border(padded,size_y,size_x,ry,rx)
+        else: pass
+        
+        out = self.out
+        if self.method == 'slice':
+            out[:] = 0
+            for u,v,w in self._terms:
+                shifted = padded[u:u+size_y,v:v+size_x]
+                if w == 1:
+                    np.add(out,shifted,out=out)
+                elif w == -1:
+                    np.subtract(out,shifted,out=out)
+                else:
+                    out += w*shifted
+        else:
+            corr = irfft2(rfft2(padded)*self._kernel,s=padded.shape)[:size_y,:size_x]
+            if out.dtype.kind == 'f':
+                out[:] = corr
+            else:
+                out[:] = np.rint(corr)
+        return out
+
+
+def energy(state,j,h,window,neighbor=None):
     """
     Compute the energies of atoms on the grid
     
@@ -22,18 +159,89 @@ def energy(state,j,h,window):
         zero means no external force
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    neighbor: optional NeighborSum of the grid and window,
+        correlate2d with the zero boundary if not given
     
     Output
     ------
     E: the energy
     """
     # sum of neighborhood spins
-    spin_sum = correlate2d(state,window,mode='same')
+    if neighbor is None:
+        spin_sum = correlate2d(state,window,mode='same')
+    else:
+        spin_sum = neighbor(state)
     E = -j*spin_sum*state - h*state
     return E
 
 
-def MH_sampling(state,j,h,beta,window):
+def flip_probability(deltaE,beta,rule='metropolis'):
+    """
+    The probability of flipping a spin changing the energy by deltaE
+    
+    Input
+    ------
+    deltaE: array of the energy differences
+    beta: temperature related, positively defined
+    rule: 'metropolis' for min(1,exp(-beta*deltaE))
+          'heatbath' for 1/(1+exp(beta*deltaE)), the spin drawn from its
+              conditional distribution given the neighbors (Glauber)
+    
+    Output
+    ------
+    p_flip: array of the probabilities
+    """
+    if rule == 'metropolis':
+        # deltaE < 0 gives exp(0) = 1, no overflow for the unlikely flips
+        return np.exp(-beta*np.maximum(deltaE,0))
+    elif rule == 'heatbath':
+        return expit(-beta*deltaE)
+    else:
+        raise ValueError('rule should be \'metropolis\' or \'heatbath\'')
+
+
+@lru_cache(maxsize=32)
+def _acceptance_table(j,h,beta,max_sum,rule):
+    spin_sum = np.arange(-max_sum,max_sum+1)
+    spin = np.array([[1],[-1]])
+    deltaE = 2*spin*(j*spin_sum+h)
+    table = flip_probability(deltaE,beta,rule)
+    # the same array is handed to every caller
+    table.setflags(write=False)
+    return table
+
+
+def acceptance_table(j,h,beta,window,rule='metropolis'):
+    """
+    The flipping probabilities, see flip_probability, of all the spins and
+    neighbor sums allowed by an integer window, built once and cached for the same
+    j, h, beta, window and rule
+    
+    Input
+    ------
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window with how many neighbors should
+        be considered to calculate the spin sum
+    rule: 'metropolis' or 'heatbath', see flip_probability
+    
+    Output
+    ------
+    table: (2,2*m+1) array with m the sum of |window|, the probability of the
+        spin s with neighbor sum S is table[(1-s)//2,S+m], None if the window is
+        not an integer array since the sums are not on a finite set
+    """
+    window = np.asarray(window)
+    if rule not in ('metropolis','heatbath'):
+        raise ValueError('rule should be \'metropolis\' or \'heatbath\'')
+    elif window.dtype.kind not in 'iu':
+        return None
+    else: pass
+    return _acceptance_table(float(j),float(h),float(beta),int(abs(window).sum()),rule)
+
+
+def MH_sampling(state,j,h,beta,window,table=None,neighbor=None):
     """
     Metropolis-Hastings algorithm for determining spin
     configuration in the next step
@@ -53,6 +261,10 @@ def MH_sampling(state,j,h,beta,window):
     beta: temperature related, positively defined
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    table: the acceptance_table of j, h, beta and window,
+        looked up if not given
+    neighbor: optional NeighborSum of the grid and window,
+        correlate2d with the zero boundary if not given
         
     Output
     ------
@@ -64,10 +276,26 @@ def MH_sampling(state,j,h,beta,window):
         raise ValueError('beta should be postively defined')
     else: pass
     
+    window = np.asarray(window)
+    if table is None:
+        table = acceptance_table(j,h,beta,window)
+    else: pass
+    if table is not None:
+        # MH SOP step 1, the neighbor sums index the flipping probabilities
+        if neighbor is None:
+            spin_sum = correlate2d(state,window,mode='same')
+        else:
+            spin_sum = neighbor(state)
+        p_flip = table[(1-state)//2,spin_sum+(table.shape[1]-1)//2]
+        # MH SOP step 2 and 3, deltaE < 0 has p_flip = 1 and always flips
+        rnd = np.random.uniform(size=state.shape)
+        return np.where(rnd < p_flip,-state,state)
+    else: pass
+    
     new_state = np.zeros_like(state)
     
     # MH SOP step 1
-    E = energy(state=state,j=j,h=h,window=window)
+    E = energy(state=state,j=j,h=h,window=window,neighbor=neighbor)
     deltaE = -2*E
     
     # MH SOP step 2 
@@ -89,11 +317,81 @@ def MH_sampling(state,j,h,beta,window):
     return new_state
 
 
+def checkerboard_sweep(padded,j,h,beta,window,table=None,boundary='zero',rule='metropolis'):
+    """
+    One sweep updating the sublattices one after the other in place.
+    The sites (a+py*k,b+px*l) with (py,px) one more than the half-sizes of the
+    window do not interact with each other, hence each sublattice is updated at
+    once and the sweep satisfies the detailed balance
+    
+    Input
+    ------
+    padded: 2D array, the spin configuration surrounded by a zero border
+        of the half-sizes of the window, updated in place
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window with odd sizes, see energy
+    table: the acceptance_table of j, h, beta, window and rule,
+        looked up if not given
+    boundary: 'zero' for no spins outside the grid
+              'periodic' for the grid wrapped around, the border is refilled
+                  after each sublattice, the sizes of the grid should be
+                  multiples of the sublattice periods
+    rule: 'metropolis' or 'heatbath', see flip_probability
+    
+    Output
+    ------
+    padded: the same array with the updated spins
+    """
+    # check if beta is positively defined
+    if beta < 0:
+        raise ValueError('beta should be postively defined')
+    else: pass
+    
+    window = np.asarray(window)
+    if table is None:
+        table = acceptance_table(j,h,beta,window,rule)
+    else: pass
+    ry,rx = window.shape[0]//2,window.shape[1]//2
+    py,px = ry+1,rx+1
+    size_y,size_x = padded.shape[0]-2*ry,padded.shape[1]-2*rx
+    if boundary == 'periodic':
+        _wrap_border(padded,size_y,size_x,ry,rx)
+    else: pass
+    neighbors = [(u,v,window[u,v]) for u,v in zip(*np.nonzero(window))]
+    for a in range(py):
+        for b in range(px):
+            # view of the sublattice, the flips are written through it
+            site = padded[ry+a:ry+size_y:py,rx+b:rx+size_x:px]
+            ny,nx = site.shape
+            if site.size == 0:
+                continue
+            else: pass
+            # sum of neighborhood spins, each term is the view of the sublattice shifted
+            # by the offset of the window, the zero border plays the role of the
+            # zero padding of correlate2d
+            spin_sum = np.zeros(site.shape,dtype=np.result_type(padded,window))
+            for u,v,w in neighbors:
+                spin_sum += w*padded[a+u:a+u+(ny-1)*py+1:py,b+v:b+v+(nx-1)*px+1:px]
+            if table is None:
+                p_flip = flip_probability(2*site*(j*spin_sum+h),beta,rule)
+            else:
+                p_flip = table[(1-site)//2,spin_sum+(table.shape[1]-1)//2]
+            flip = np.random.uniform(size=site.shape) < p_flip
+            site *= 1-2*flip
+            if boundary == 'periodic':
+                _wrap_border(padded,size_y,size_x,ry,rx)
+            else: pass
+    return padded
+
+
 def spinMH(size=[500,500],p0=[0.5,0.5],j=1,h=0,beta=1,iters=100,    \
            seed=None,window=np.array([[1,1,1],                      \
                                       [1,0,1],                      \
-                                      [1,1,1]])                     \
-          ):
+                                      [1,1,1]]),                    \
+           method='sync',boundary='zero',neighbor='auto',rule='metropolis',  \
+           backend='numba'):
     """
     Using Metropolis-Hastings algorithm to sample the
     evolution of the spin configuration of a given initial
@@ -117,6 +415,28 @@ def spinMH(size=[500,500],p0=[0.5,0.5],j=1,h=0,beta=1,iters=100,    \
     seed: the seed for grenerating the initial state 
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    method: 'sync' updates all spins at the same time, see MH_sampling
+            'checkerboard' updates the sublattices one after the other in place,
+            see checkerboard_sweep, the window should have odd sizes
+            'multispin' is the checkerboard sweep of one bit per spin, see
+            multispin.multispin_sweep, the window should only have the weights
+            0 and 1, the boundary is periodic and the number of columns should
+            be a multiple of 64
+            'sequential' updates one random site at a time, one sweep is as
+            many updates as sites, see ising_numba.sequential_sweep, it is
+            for the random-site dynamics and is slower than the sync and
+            checkerboard sweeps
+    boundary: 'zero' for no spins outside the grid or 'periodic' for the grid
+              wrapped around, for the checkerboard and multispin sweeps the sizes
+              of the grid should be multiples of the half-sizes of the window plus one
+    neighbor: the NeighborSum method of the sync update, 'auto', 'slice',
+              'fft' or 'direct'
+    rule: 'metropolis' or 'heatbath' of the checkerboard, multispin and
+          sequential sweeps, see flip_probability, the sync update is Metropolis
+    backend: 'numba' runs the sequential sweep with the compiled kernel, falls
+             back to 'numpy' without numba, 'numpy' runs the checkerboard sweep
+             instead since the sequential sweep has no NumPy version, a warning is
+             issued when the checkerboard sweep is substituted
         
     Output
     ------
@@ -124,11 +444,90 @@ def spinMH(size=[500,500],p0=[0.5,0.5],j=1,h=0,beta=1,iters=100,    \
     final: the final spin configuration
     """
     window = np.asarray(window)
+    # check if beta is positively defined
+    if beta < 0:
+        raise ValueError('beta should be postively defined')
+    else: pass
+    if method not in ('sync','checkerboard','multispin','sequential'):
+        raise ValueError('method should be \'sync\', \'checkerboard\', \'multispin\' or \'sequential\'')
+    elif backend not in ('numba','numpy'):
+        raise ValueError('backend should be \'numba\' or \'numpy\'')
+    elif rule not in ('metropolis','heatbath'):
+        raise ValueError('rule should be \'metropolis\' or \'heatbath\'')
+    elif method == 'sync' and rule != 'metropolis':
+        raise ValueError('The sync update only has the Metropolis rule')
+    else: pass
+    if method == 'sequential':
+        from ising_numba import numba_flag
+        
+        if backend == 'numpy':
+            warnings.warn('The sequential sweep is not vectorized, the checkerboard sweep '
+                          'is used with backend=\'numpy\'',stacklevel=2)
+            method = 'checkerboard'
+        elif not numba_flag:
+            warnings.warn('The sequential sweep needs numba, the checkerboard sweep is used '
+                          'instead',stacklevel=2)
+            method = 'checkerboard'
+        else: pass
+    else: pass
+    if method != 'sync' and (window.shape[0] % 2 == 0 or window.shape[1] % 2 == 0):
+        raise ValueError('The window should have odd sizes for the '+method+' sweep')
+    elif boundary not in ('zero','periodic'):
+        raise ValueError('boundary should be \'zero\' or \'periodic\'')
+    elif method == 'multispin' and boundary != 'periodic':
+        raise ValueError('The multispin sweep only has the periodic boundary')
+    elif method == 'sequential' and boundary == 'periodic' and \
+         (window.shape[0] > size[0] or window.shape[1] > size[1]):
+        raise ValueError('The window should not be larger than the grid for the periodic boundary')
+    elif method in ('checkerboard','multispin') and boundary == 'periodic' and \
+         (size[0] % (window.shape[0]//2+1) != 0 or size[1] % (window.shape[1]//2+1) != 0):
+        raise ValueError('The grid sizes should be multiples of the sublattice periods '
+                         +str((window.shape[0]//2+1,window.shape[1]//2+1))
+                         +' for the periodic '+method+' sweep')
+    else: pass
+    # the flipping probabilities are computed once for all the iterations
+    table = acceptance_table(j,h,beta,window,rule)
     np.random.seed(seed)
+    
+    if method == 'multispin':
+        from multispin import init_packed,unpack,multispin_sweep
+        
+        # the same initial state as the other methods drawn without the int64 array
+        packed = init_packed(size,p0)
+        ini_state = unpack(packed)
+        # the random words of the sweeps from a generator seeded by the global state
+        rng = np.random.default_rng(np.random.randint(2**31))
+        for i in range(iters):
+            multispin_sweep(packed,j,h,beta,window,table,rule=rule,rng=rng)
+        return ini_state,unpack(packed)
+    else: pass
+    
     ini_state = np.random.choice([1,-1],size=(size[0],size[1]),p=p0)
-    new_state = np.copy(ini_state)
     
+    if method in ('checkerboard','sequential'):
+        # the spins live inside a zero border, no copy is made during the sweeps
+        ry,rx = window.shape[0]//2,window.shape[1]//2
+        dtype = np.int8 if method == 'sequential' else ini_state.dtype
+        padded = np.zeros((size[0]+2*ry,size[1]+2*rx),dtype=dtype)
+        padded[ry:ry+size[0],rx:rx+size[1]] = ini_state
+        if method == 'sequential':
+            from ising_numba import sequential_sweep
+            
+            # the counter-based random numbers of the sweeps keyed by the global state
+            key = np.random.randint(2**63)
+            counter = 0
+            for i in range(iters):
+                counter = sequential_sweep(padded,j,h,beta,window,table,boundary,rule,key,counter)
+        else:
+            for i in range(iters):
+                checkerboard_sweep(padded,j,h,beta,window,table,boundary,rule)
+        # the final state has the dtype of the initial one as in the other methods
+        return ini_state,padded[ry:ry+size[0],rx:rx+size[1]].astype(ini_state.dtype)
+    else: pass
+    
+    neighbor = NeighborSum(size,window,method=neighbor,boundary=boundary)
+    new_state = np.copy(ini_state)
     for i in range(iters):
-        new_state= MH_sampling(new_state,j,h,beta,window)
+        new_state= MH_sampling(new_state,j,h,beta,window,table,neighbor)
     
     return ini_state,new_state
\ No newline at end of file
@@ -1,10 +1,145 @@
+from functools import lru_cache
 import cupy as cp
 from cupyx.scipy.signal import correlate2d
 
 
 gpu_flag = True
 
-def energy(state,j,h,window):
+# 'auto' sums the shifted slices up to this number of nonzero weights in the window
+# and uses the FFT above, see benchmark.py
+_slice_max = 120
+
+
+def _wrap_border(padded,size_y,size_x,ry,rx):
+    """
+    Fill the border of the half-sizes (ry,rx) around the grid padded[ry:ry+size_y,rx:rx+size_x]
+    with the spins of the opposite edges, the periodic boundary
+    """
+    padded[:ry,rx:rx+size_x] = padded[size_y:size_y+ry,rx:rx+size_x]
+    padded[ry+size_y:ry+size_y+ry,rx:rx+size_x] = padded[ry:2*ry,rx:rx+size_x]
+    padded[:size_y+2*ry,:rx] = padded[:size_y+2*ry,size_x:size_x+rx]
+    padded[:size_y+2*ry,rx+size_x:rx+size_x+rx] = padded[:size_y+2*ry,rx:2*rx]
+
+
+class NeighborSum:
+    """
+    Sums of neighborhood spins of a grid of fixed size, the same as
+    correlate2d(state,window,mode='same') for the zero boundary. The buffers are
+    allocated once and reused by every call
+    
+    Input
+    ------
+    size: the size of the grid
+    window: a 2D window with how many neighbors should
+        be considered to calculate the spin sum
+    method: 'slice' adds the shifted slices of the state for each nonzero weight
+                of the window into an int8 or int16 buffer, for small windows
+            'fft' correlates with the FFT of the window, for large windows
+            'direct' is correlate2d
+            'auto' picks 'slice' for at most _slice_max nonzero weights and 'fft'
+                otherwise, 'direct' for windows with even sizes
+    boundary: 'zero' for no spins outside the grid
+              'periodic' for the grid wrapped around, the window should not
+                  be larger than the grid
+    """
+    
+    def __init__(self,size,window,method='auto',boundary='zero'):
+        window = cp.asarray(window)
+        odd = window.shape[0] % 2 == 1 and window.shape[1] % 2 == 1
+        if method == 'auto':
+            if not odd:
+                method = 'direct'
+            elif int(cp.count_nonzero(window)) <= _slice_max:
+                method = 'slice'
+            else:
+                method = 'fft'
+        elif method not in ('slice','fft','direct'):
+            raise ValueError('method should be \'auto\', \'slice\', \'fft\' or \'direct\'')
+        elif method != 'direct' and not odd:
+            raise ValueError('The window should have odd sizes for method \''+method+'\'')
+        else: pass
+        if boundary not in ('zero','periodic'):
+            raise ValueError('boundary should be \'zero\' or \'periodic\'')
+        elif boundary == 'periodic' and (window.shape[0] > size[0] or window.shape[1] > size[1]):
+            raise ValueError('The window should not be larger than the grid for the periodic boundary')
+        else: pass
+        self.size = (size[0],size[1])
+        self.window = window
+        self.method = method
+        self.boundary = boundary
+        self.ry,self.rx = window.shape[0]//2,window.shape[1]//2
+        
+        # the sums of an integer window are integers, the smallest integer type holding
+        # the sums and the table indices, see acceptance_table, is enough
+        if window.dtype.kind in 'iu':
+            max_sum = int(cp.abs(window).sum())
+            if 2*max_sum <= cp.iinfo(cp.int8).max:
+                dtype = cp.int8
+            elif 2*max_sum <= cp.iinfo(cp.int16).max:
+                dtype = cp.int16
+            else:
+                dtype = cp.int64
+        else:
+            dtype = cp.float64
+        self.out = cp.empty(self.size,dtype=dtype)
+        
+        shape = (self.size[0]+2*self.ry,self.size[1]+2*self.rx)
+        if method == 'slice':
+            self._padded = cp.zeros(shape,dtype=dtype)
+            # the offsets are read on the host, the window is small
+            window_host = cp.asnumpy(window)
+            self._terms = [(u,v,window_host[u,v]) for u,v in zip(*window_host.nonzero())]
+        elif method == 'fft':
+            # the circular correlation of the padded grid does not wrap around
+            # for the sites of the grid
+            self._padded = cp.zeros(shape)
+            kernel = cp.zeros(shape)
+            kernel[:window.shape[0],:window.shape[1]] = window
+            self._kernel = cp.conj(cp.fft.rfft2(kernel))
+        else: pass
+    
+    def __call__(self,state):
+        """
+        The sums of neighborhood spins of state, the returned array is the buffer
+        overwritten by the next call
+        """
+        size_y,size_x = self.size
+        ry,rx = self.ry,self.rx
+        if self.method == 'direct':
+            if self.boundary == 'periodic':
+                self.out[:] = correlate2d(state,self.window,mode='same',boundary='wrap')
+            else:
+                self.out[:] = correlate2d(state,self.window,mode='same')
+            return self.out
+        else: pass
+        
+        padded = self._padded
+        padded[ry:ry+size_y,rx:rx+size_x] = state
+        if self.boundary == 'periodic':
+            _wrap_border(padded,size_y,size_x,ry,rx)
+        else: pass
+        
+        out = self.out
+        if self.method == 'slice':
+            out[:] = 0
+            for u,v,w in self._terms:
+                shifted = padded[u:u+size_y,v:v+size_x]
+                if w == 1:
+                    cp.add(out,shifted,out=out)
+                elif w == -1:
+                    cp.subtract(out,shifted,out=out)
+                else:
+                    out += w*shifted
+        else:
+            corr = cp.fft.irfft2(cp.fft.rfft2(padded)*self._kernel,s=padded.shape)[:size_y,:size_x]
+            if out.dtype.kind == 'f':
+                out[:] = corr
+            else:
+                out[:] = cp.rint(corr)
+        return out
+
+
+def energy(state,j,h,window,neighbor=None):
     """
     Compute the energies of atoms on the grid
     
@@ -22,18 +157,60 @@ def energy(state,j,h,window):
         zero means no external force
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    neighbor: optional NeighborSum of the grid and window,
+        correlate2d with the zero boundary if not given
     
     Output
     ------
     E: the energy
     """
     # sum of neighborhood spins
-    spin_sum = correlate2d(state,window,mode='same')
+    if neighbor is None:
+        spin_sum = correlate2d(state,window,mode='same')
+    else:
+        spin_sum = neighbor(state)
     E = -j*spin_sum*state - h*state
     return E
 
 
-def MH_sampling(state,j,h,beta,window):
+@lru_cache(maxsize=32)
+def _acceptance_table(j,h,beta,max_sum):
+    spin_sum = cp.arange(-max_sum,max_sum+1)
+    spin = cp.array([[1],[-1]])
+    deltaE = 2*spin*(j*spin_sum+h)
+    # deltaE < 0 gives exp(0) = 1, no overflow for the unlikely flips
+    return cp.exp(-beta*cp.maximum(deltaE,0))
+
+
+def acceptance_table(j,h,beta,window):
+    """
+    The flipping probabilities min(1,exp(-beta*deltaE)) of all the spins and
+    neighbor sums allowed by an integer window, built once and cached for the same
+    j, h, beta and window
+    
+    Input
+    ------
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window with how many neighbors should
+        be considered to calculate the spin sum
+    
+    Output
+    ------
+    table: (2,2*m+1) array with m the sum of |window|, the probability of the
+        spin s with neighbor sum S is table[(1-s)//2,S+m], None if the window is
+        not an integer array since the sums are not on a finite set. The cupy
+        arrays cannot be made read-only, hence each call gets a copy of the cached table
+    """
+    window = cp.asarray(window)
+    if window.dtype.kind not in 'iu':
+        return None
+    else: pass
+    return _acceptance_table(float(j),float(h),float(beta),int(abs(window).sum())).copy()
+
+
+def MH_sampling(state,j,h,beta,window,table=None,neighbor=None):
     """
     Metropolis-Hastings algorithm for determining spin
     configuration in the next step
@@ -53,6 +230,10 @@ def MH_sampling(state,j,h,beta,window):
     beta: temperature related, positively defined
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    table: the acceptance_table of j, h, beta and window,
+        looked up if not given
+    neighbor: optional NeighborSum of the grid and window,
+        correlate2d with the zero boundary if not given
         
     Output
     ------
@@ -64,10 +245,26 @@ def MH_sampling(state,j,h,beta,window):
         raise ValueError('beta should be postively defined')
     else: pass
     
+    window = cp.asarray(window)
+    if table is None:
+        table = acceptance_table(j,h,beta,window)
+    else: pass
+    if table is not None:
+        # MH SOP step 1, the neighbor sums index the flipping probabilities
+        if neighbor is None:
+            spin_sum = correlate2d(state,window,mode='same')
+        else:
+            spin_sum = neighbor(state)
+        p_flip = table[(1-state)//2,spin_sum+(table.shape[1]-1)//2]
+        # MH SOP step 2 and 3, deltaE < 0 has p_flip = 1 and always flips
+        rnd = cp.random.uniform(size=state.shape)
+        return cp.where(rnd < p_flip,-state,state)
+    else: pass
+    
     new_state = cp.zeros_like(state)
     
     # MH SOP step 1
-    E = energy(state=state,j=j,h=h,window=window)
+    E = energy(state=state,j=j,h=h,window=window,neighbor=neighbor)
     deltaE = -2*E
     
     # MH SOP step 2 
@@ -89,11 +286,82 @@ def MH_sampling(state,j,h,beta,window):
     return new_state
 
 
+def checkerboard_sweep(padded,j,h,beta,window,table=None,boundary='zero'):
+    """
+    One Metropolis sweep updating the sublattices one after the other in place.
+    The sites (a+py*k,b+px*l) with (py,px) one more than the half-sizes of the
+    window do not interact with each other, hence each sublattice is updated at
+    once and the sweep satisfies the detailed balance
+    
+    Input
+    ------
+    padded: 2D array, the spin configuration surrounded by a zero border
+        of the half-sizes of the window, updated in place
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window with odd sizes, see energy
+    table: the acceptance_table of j, h, beta and window,
+        looked up if not given
+    boundary: 'zero' for no spins outside the grid
+              'periodic' for the grid wrapped around, the border is refilled
+                  after each sublattice, the sizes of the grid should be
+                  multiples of the sublattice periods
+    
+    Output
+    ------
+    padded: the same array with the updated spins
+    """
+    # check if beta is positively defined
+    if beta < 0:
+        raise ValueError('beta should be postively defined')
+    else: pass
+    
+    window = cp.asarray(window)
+    if table is None:
+        table = acceptance_table(j,h,beta,window)
+    else: pass
+    ry,rx = window.shape[0]//2,window.shape[1]//2
+    py,px = ry+1,rx+1
+    size_y,size_x = padded.shape[0]-2*ry,padded.shape[1]-2*rx
+    if boundary == 'periodic':
+        _wrap_border(padded,size_y,size_x,ry,rx)
+    else: pass
+    # the offsets are read on the host, the window is small
+    window_host = cp.asnumpy(window)
+    neighbors = [(u,v,window_host[u,v]) for u,v in zip(*window_host.nonzero())]
+    for a in range(py):
+        for b in range(px):
+            # view of the sublattice, the flips are written through it
+            site = padded[ry+a:ry+size_y:py,rx+b:rx+size_x:px]
+            ny,nx = site.shape
+            if site.size == 0:
+                continue
+            else: pass
+            # sum of neighborhood spins, each term is the view of the sublattice shifted
+            # by the offset of the window, the zero border plays the role of the
+            # zero padding of correlate2d
+            spin_sum = cp.zeros(site.shape,dtype=cp.result_type(padded,window))
+            for u,v,w in neighbors:
+                spin_sum += w*padded[a+u:a+u+(ny-1)*py+1:py,b+v:b+v+(nx-1)*px+1:px]
+            if table is None:
+                # deltaE < 0 always flips since its probability exceeds 1
+                p_flip = cp.exp(-beta*2*site*(j*spin_sum+h))
+            else:
+                p_flip = table[(1-site)//2,spin_sum+(table.shape[1]-1)//2]
+            flip = cp.random.uniform(size=site.shape) < p_flip
+            site *= 1-2*flip
+            if boundary == 'periodic':
+                _wrap_border(padded,size_y,size_x,ry,rx)
+            else: pass
+    return padded
+
+
 def spinMH(size=[500,500],p0=[0.5,0.5],j=1,h=0,beta=1,iters=100,    \
            seed=None,window=cp.array([[1,1,1],                      \
                                       [1,0,1],                      \
-                                      [1,1,1]])                     \
-          ):
+                                      [1,1,1]]),                    \
+           method='sync',boundary='zero',neighbor='auto'):
     """
     Using Metropolis-Hastings algorithm to sample the
     evolution of the spin configuration of a given initial
@@ -117,17 +385,55 @@ def spinMH(size=[500,500],p0=[0.5,0.5],j=1,h=0,beta=1,iters=100,    \
     seed: the seed for grenerating the initial state 
     window: a 2D window with how many neighbors should
         be considered to calculate the spin sum
+    method: 'sync' updates all spins at the same time, see MH_sampling
+            'checkerboard' updates the sublattices one after the other in place,
+            see checkerboard_sweep, the window should have odd sizes
+    boundary: 'zero' for no spins outside the grid or 'periodic' for the grid
+              wrapped around, for the checkerboard sweep the sizes of the grid
+              should be multiples of the half-sizes of the window plus one
+    neighbor: the NeighborSum method of the sync update, 'auto', 'slice',
+              'fft' or 'direct'
         
     Output
     ------
     ini: the initial spin configuration
     final: the final spin configuration
     """
+    window = cp.asarray(window)
+    # check if beta is positively defined
+    if beta < 0:
+        raise ValueError('beta should be postively defined')
+    else: pass
+    if method not in ('sync','checkerboard'):
+        raise ValueError('method should be \'sync\' or \'checkerboard\'')
+    elif method == 'checkerboard' and (window.shape[0] % 2 == 0 or window.shape[1] % 2 == 0):
+        raise ValueError('The window should have odd sizes for the checkerboard sweep')
+    elif boundary not in ('zero','periodic'):
+        raise ValueError('boundary should be \'zero\' or \'periodic\'')
+    elif method == 'checkerboard' and boundary == 'periodic' and \
+         (size[0] % (window.shape[0]//2+1) != 0 or size[1] % (window.shape[1]//2+1) != 0):
+        raise ValueError('The grid sizes should be multiples of the sublattice periods '
+                         +str((window.shape[0]//2+1,window.shape[1]//2+1))
+                         +' for the periodic checkerboard sweep')
+    else: pass
+    # the flipping probabilities are computed once for all the iterations
+    table = acceptance_table(j,h,beta,window)
     cp.random.seed(seed)
     ini_state = cp.random.choice([1,-1],size=(size[0],size[1]),p=p0)
-    new_state = cp.copy(ini_state)
     
+    if method == 'checkerboard':
+        # the spins live inside a zero border, no copy is made during the sweeps
+        ry,rx = window.shape[0]//2,window.shape[1]//2
+        padded = cp.zeros((size[0]+2*ry,size[1]+2*rx),dtype=ini_state.dtype)
+        padded[ry:ry+size[0],rx:rx+size[1]] = ini_state
+        for i in range(iters):
+            checkerboard_sweep(padded,j,h,beta,window,table,boundary)
+        return cp.asnumpy(ini_state),cp.asnumpy(padded[ry:ry+size[0],rx:rx+size[1]])
+    else: pass
+    
+    neighbor = NeighborSum(size,window,method=neighbor,boundary=boundary)
+    new_state = cp.copy(ini_state)
     for i in range(iters):
-        new_state= MH_sampling(new_state,j,h,beta,window)
+        new_state= MH_sampling(new_state,j,h,beta,window,table,neighbor)
     
     return cp.asnumpy(ini_state),cp.asnumpy(new_state)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import math
+import numpy as np
+from ising import acceptance_table,_wrap_border
+
+try:
+    from numba import njit
+    numba_flag = True
+except ImportError:
+    numba_flag = False
+
+
+if numba_flag:
+    
+    @njit(cache=True)
+    def _splitmix64(key,counter):
+        # counter-based random words, the output of SplitMix64 seeded by key after
+        # counter steps, hence any number of the stream is drawn without a state
+        z = key+counter*np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+    
+    @njit(cache=True)
+    def _uniform(key,counter):
+        # the 53 most significant bits as a double in [0,1)
+        return (_splitmix64(key,counter) >> np.uint64(11))*(1./9007199254740992.)
+    
+    @njit(cache=True)
+    def _sweep_kernel(padded,ry,rx,offsets,weights,zero,table,max_sum,j,h,beta,heatbath,periodic,
+                      key,counter):
+        # zero is the 0 of the dtype of weights, the start of the spin sums
+        size_y,size_x = padded.shape[0]-2*ry,padded.shape[1]-2*rx
+        stride = padded.shape[1]
+        flat = padded.ravel()
+        num = size_y*size_x
+        for k in range(num):
+            # random site and random number of the update
+            site = min(int(_uniform(key,counter)*num),num-1)
+            u = _uniform(key,counter+np.uint64(1))
+            counter += np.uint64(2)
+            y = site//size_x
+            x = site-y*size_x
+            pos = (y+ry)*stride+x+rx
+        
+            # sum of neighborhood spins, the border holds the zero or the wrapped spins
+            spin_sum = zero
+            for n in range(weights.size):
+                spin_sum += weights[n]*flat[pos+offsets[n]]
+        
+            s = flat[pos]
+            if table.shape[1] > 0:
+                p_flip = table[(1-s)//2,int(spin_sum)+max_sum]
+            else:
+                deltaE = 2*s*(j*spin_sum+h)
+                if heatbath:
+                    p_flip = 1./(1.+math.exp(min(beta*deltaE,700.)))
+                else:
+                    p_flip = math.exp(-beta*max(deltaE,0.))
+            if u < p_flip:
+                flat[pos] = -s
+                # the copies of the spins near the edges in the wrapped border
+                if periodic and (y < ry or y >= size_y-ry or x < rx or x >= size_x-rx):
+                    for yy in (y-size_y,y,y+size_y):
+                        if yy < -ry or yy >= size_y+ry:
+                            continue
+                        for xx in (x-size_x,x,x+size_x):
+                            if xx < -rx or xx >= size_x+rx:
+                                continue
+                            flat[(yy+ry)*stride+xx+rx] = -s
+        return counter
+
+
+def sequential_sweep(padded,j,h,beta,window,table=None,boundary='zero',rule='metropolis',
+                     key=0,counter=0):
+    """
+    One sweep of random-site updates compiled by numba, as many single spin updates
+    at uniformly drawn sites as the sites of the grid, in place. The random numbers
+    are the counter-based SplitMix64 stream of key, the next sweep continues from
+    the returned counter
+    
+    Input
+    ------
+    padded: 2D int8 array, the spin configuration surrounded by a border of the
+        half-sizes of the window, see checkerboard_sweep of ising, updated in place
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window with odd sizes, see energy of ising
+    table: the acceptance_table of j, h, beta, window and rule,
+        looked up if not given
+    boundary: 'zero' for no spins outside the grid
+              'periodic' for the grid wrapped around, the window should not
+                  be larger than the grid
+    rule: 'metropolis' or 'heatbath', see flip_probability of ising
+    key: the seed of the random numbers
+    counter: position in the random numbers, two per update
+    
+    Output
+    ------
+    counter: position in the random numbers after the sweep
+    """
+    if not numba_flag:
+        raise ImportError('sequential_sweep needs numba')
+    elif beta < 0:
+        raise ValueError('beta should be postively defined')
+    elif padded.dtype != np.int8 or not padded.flags.c_contiguous:
+        raise ValueError('The spins should be a C-contiguous int8 array')
+    elif boundary not in ('zero','periodic'):
+        raise ValueError('boundary should be \'zero\' or \'periodic\'')
+    else: pass
+    
+    window = np.asarray(window)
+    if table is None:
+        table = acceptance_table(j,h,beta,window,rule)
+    else: pass
+    if table is None:
+        # non-integer window, the probabilities are computed for each update
+        table = np.zeros((2,0))
+        max_sum = 0
+    else:
+        max_sum = (table.shape[1]-1)//2
+    ry,rx = window.shape[0]//2,window.shape[1]//2
+    if boundary == 'periodic':
+        _wrap_border(padded,padded.shape[0]-2*ry,padded.shape[1]-2*rx,ry,rx)
+    else: pass
+    u,v = np.nonzero(window)
+    # offsets of the neighbors in the flattened array
+    offsets = ((u-ry)*padded.shape[1]+(v-rx)).astype(np.int64)
+    if window.dtype.kind in 'iu':
+        weights = window[u,v].astype(np.int64)
+    else:
+        weights = window[u,v].astype(np.float64)
+    return int(_sweep_kernel(padded,ry,rx,offsets,weights,weights.dtype.type(0),table,max_sum,
+                             float(j),float(h),
+                             float(beta),rule == 'heatbath',boundary == 'periodic',
+                             np.uint64(key),np.uint64(counter)))
@@ -0,0 +1,236 @@
+import numpy as np
+from ising import acceptance_table
+
+
+def pack(state):
+    """
+    Pack the spin configuration into one bit per spin, the bit b of the
+    word w in a row is the spin of column 64*w+b, 1 for spin-up
+    
+    Input
+    ------
+    state: 2D array, +1 for spin-up and -1 for spin-down, the
+        number of columns should be a multiple of 64
+    
+    Output
+    ------
+    packed: 2D uint64 array of shape (rows,columns//64)
+    """
+    state = np.asarray(state)
+    if state.shape[1] % 64 != 0:
+        raise ValueError('The number of columns should be a multiple of 64')
+    else: pass
+    bytes_ = np.packbits(state > 0,axis=1,bitorder='little')
+    return bytes_.view('<u8').astype(np.uint64,copy=False)
+
+
+def unpack(packed):
+    """
+    The spin configuration of pack as an int8 array of +1 and -1
+    """
+    bytes_ = np.ascontiguousarray(packed,dtype='<u8').view(np.uint8)
+    bits = np.unpackbits(bytes_,axis=1,bitorder='little').view(np.int8)
+    bits *= 2
+    bits -= 1
+    return bits
+
+
+def init_packed(size,p0=[0.5,0.5]):
+    """
+    Packed initial spin configuration drawn row by row, the same configuration as
+    np.random.choice([1,-1],size=size,p=p0) without the int64 array of all spins
+    
+    Input
+    ------
+    size: the size of the grid, the number of columns should be a multiple of 64
+    p0: the probability of spin is being up or down
+    
+    Output
+    ------
+    packed: 2D uint64 array of shape (size[0],size[1]//64)
+    """
+    if size[1] % 64 != 0:
+        raise ValueError('The number of columns should be a multiple of 64')
+    else: pass
+    p_up = p0[0]/(p0[0]+p0[1])
+    packed = np.empty((size[0],size[1]//64),dtype=np.uint64)
+    # the rows of 8 MB of uniform numbers at a time, choice draws them in the same order
+    rows = max(1,2**20//size[1])
+    for i in range(0,size[0],rows):
+        packed[i:i+rows] = pack(np.random.random_sample((min(rows,size[0]-i),size[1])) < p_up)
+    return packed
+
+
+def _random_words(shape,planes,rng=None):
+    """
+    planes arrays of random uint64 words of the shape drawn from the numpy.random.Generator
+    rng, or from the global state of np.random if rng is None
+    """
+    shape = (planes,)+tuple(shape)
+    if rng is None:
+        return np.frombuffer(np.random.bytes(8*int(np.prod(shape))),dtype=np.uint64).reshape(shape)
+    else:
+        return rng.integers(0,2**64,size=shape,dtype=np.uint64)
+
+
+def _shift_columns(words,dx):
+    """
+    The spins of column x+dx at the bit of column x, periodic along the rows
+    """
+    if dx == 0:
+        return words
+    elif dx > 0:
+        return (words >> dx) | (np.roll(words,-1,axis=1) << (64-dx))
+    else:
+        return (words << -dx) | (np.roll(words,1,axis=1) >> (64+dx))
+
+
+def _add_bit(counter,bit):
+    """
+    Add the bit of every spin to the bit-sliced counter, the planes from the
+    least significant one, in place by a ripple-carry adder
+    """
+    carry = bit
+    for i in range(len(counter)):
+        counter[i],carry = counter[i] ^ carry,counter[i] & carry
+
+
+def _equal(counter,value,ones):
+    """
+    The bits of the spins whose counter equals value
+    """
+    mask = ones
+    for i in range(len(counter)):
+        if (value >> i) & 1:
+            mask = mask & counter[i]
+        else:
+            mask = mask & ~counter[i]
+    return mask
+
+
+def multispin_sweep(packed,j,h,beta,window,table=None,bits=32,rng=None,rule='metropolis'):
+    """
+    One sweep of the packed spins with the periodic boundary, see
+    checkerboard_sweep of ising. The sublattices are the rows of the same color
+    and a bit mask of the columns of the same color. The number of anti-aligned
+    neighbors of 64 spins at once is counted by bitwise adders and the spins are
+    flipped with a bit-sliced comparison of random words against the flipping
+    probabilities, hence no spin is unpacked during the sweep
+    
+    Input
+    ------
+    packed: 2D uint64 array of pack, updated in place
+    j: coupling constant
+    h: spin tendency, contribution from external force
+    beta: temperature related, positively defined
+    window: a 2D window of 0 and 1 with odd sizes and
+        half-sizes smaller than 64
+    table: the acceptance_table of j, h, beta, window and rule,
+        looked up if not given
+    bits: precision of the flipping probabilities, they
+        are rounded down to multiples of 2^-bits
+    rng: optional numpy.random.Generator of the random words, much
+        faster than the global state of np.random used if not given
+    rule: 'metropolis' or 'heatbath', see flip_probability of ising
+    
+    Output
+    ------
+    packed: the same array with the updated spins
+    """
+    # check if beta is positively defined
+    if beta < 0:
+        raise ValueError('beta should be postively defined')
+    else: pass
+    
+    window = np.asarray(window)
+    if not np.isin(window,(0,1)).all():
+        raise ValueError('The window should only have the weights 0 and 1 for the multispin sweep')
+    else: pass
+    if table is None:
+        table = acceptance_table(j,h,beta,window,rule)
+    else: pass
+    ry,rx = window.shape[0]//2,window.shape[1]//2
+    py,px = ry+1,rx+1
+    size_y,size_x = packed.shape[0],64*packed.shape[1]
+    offsets = [(int(u)-ry,int(v)-rx) for u,v in zip(*np.nonzero(window))]
+    num = len(offsets)
+    
+    # the flipping probabilities of the spin s with A anti-aligned neighbors, the
+    # neighbor sum is s*(num-2A), as integer thresholds of bits random bits. The
+    # counts with the same threshold for both spins need no spin mask
+    threshold = np.floor(table*2.**bits)
+    levels = {}
+    for count in range(num+1):
+        up,down = threshold[0,2*num-2*count],threshold[1,2*count]
+        if up == down:
+            levels.setdefault(up,[]).append((count,None))
+        else:
+            levels.setdefault(up,[]).append((count,True))
+            levels.setdefault(down,[]).append((count,False))
+    
+    planes = max(1,num.bit_length())
+    # the colors of the columns in each word of the rows
+    col_masks = [pack(np.arange(size_x)[None,:] % px == b)[0] for b in range(px)]
+    # the rows of the same color do not interact, they are updated in blocks of about
+    # 2^16 words to keep the temporaries small for large grids
+    block = py*max(1,2**16//packed.shape[1])
+    for a in range(py):
+        for start in range(a,size_y,block):
+            rows = np.arange(start,min(start+block,size_y),py)
+            # the colors of the columns use different bits of the same random words
+            rand = _random_words((len(rows),packed.shape[1]),bits,rng)
+            for b in range(px):
+                site = packed[rows]
+                ones = np.full(site.shape,~np.uint64(0))
+    
+                # bit-sliced number of anti-aligned neighbors
+                counter = [np.zeros_like(site) for i in range(planes)]
+                for dy,dx in offsets:
+                    neighbor = _shift_columns(packed[(rows+dy) % size_y],dx)
+                    _add_bit(counter,site ^ neighbor)
+    
+                # bit-sliced thresholds of every spin, the spins to flip for sure are kept apart
+                always = np.zeros_like(site)
+                thresh = [None]*bits
+                for value,members in levels.items():
+                    if value == 0:
+                        continue
+                    else: pass
+                    mask = np.zeros_like(site)
+                    for count,spin_up in members:
+                        match = _equal(counter,count,ones)
+                        if spin_up is None:
+                            mask |= match
+                        elif spin_up:
+                            mask |= match & site
+                        else:
+                            mask |= match & ~site
+                    if value >= 2.**bits:
+                        always |= mask
+                        continue
+                    else: pass
+                    value = int(value)
+                    for i in range(bits):
+                        if (value >> i) & 1:
+                            thresh[i] = mask if thresh[i] is None else thresh[i] | mask
+                        else: pass
+    
+                # random number < threshold, compared from the most significant bit
+                less = np.zeros_like(site)
+                equal = ones.copy()
+                tmp = np.empty_like(site)
+                for i in range(bits-1,-1,-1):
+                    np.invert(rand[i],out=tmp)
+                    if thresh[i] is None:
+                        equal &= tmp
+                    else:
+                        tmp &= thresh[i]
+                        tmp &= equal
+                        less |= tmp
+                        np.bitwise_xor(rand[i],thresh[i],out=tmp)
+                        np.invert(tmp,out=tmp)
+                        equal &= tmp
+    
+                flip = (always | less) & col_masks[b]
+                packed[rows] = site ^ flip
+    return packed
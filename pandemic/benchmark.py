@@ -0,0 +1,79 @@
+import sys
+import numpy as np
+from timeit import default_timer as timer
+from core import init_ill,init_health,sub_stat,next_pos_v,Population
+from core_numba import JitPopulation,numba_flag
+
+
+################################################
+#                                              #
+#          Benchmark of the step engines       #
+#                                              #
+################################################
+
+
+inf_spec = [1,0.25,0.5]
+recov_spec = [35*24,10*24]
+dead_spec = [40*24,10*24]
+vrange = [5,30]
+dt = 0.5
+
+
+def _setup(num,seed=0):
+    """
+    Initial condition with 1% ill subjects, the box grows with num so that the
+    density is the same, 1 subject per 16 m^2
+    """
+    np.random.seed(seed)
+    half = 2*np.sqrt(num)
+    box_size = np.array([[-half,half],[-half,half]])
+    n_ill = max(num//100,1)
+    xi,vi,ti = init_ill(recov_spec,dead_spec,box_size,vrange,n_ill)
+    xh,vh = init_health(box_size,vrange,num-n_ill)
+    return box_size,xi,xh,vi,vh,ti
+
+
+def bench_tuple(num,steps,search='cell'):
+    """
+    Seconds per step of sub_stat and next_pos_v
+    """
+    box_size,xi,xh,vi,vh,ti = _setup(num)
+    xr = np.array([[],[]])
+    vr = np.array([[],[]])
+    xd = np.array([[],[]])
+    start = timer()
+    for s in range(steps):
+        time = (s+1)*dt
+        xi,xh,xr,xd,vi,vh,vr,ti = sub_stat(xi,xh,xr,xd,vi,vh,vr,ti,dt,time,inf_spec,
+                                           recov_spec,dead_spec,None,search)
+        xi,vi = next_pos_v(xi,vi,box_size,dt)
+        xh,vh = next_pos_v(xh,vh,box_size,dt)
+        xr,vr = next_pos_v(xr,vr,box_size,dt)
+    return (timer()-start)/steps
+
+
+def bench_population(cls,num,steps,search='cell'):
+    """
+    Seconds per step of Population.step or JitPopulation.step
+    """
+    box_size,xi,xh,vi,vh,ti = _setup(num)
+    pop = cls(xi,xh,vi,vh,ti)
+    # warm up, the numba kernel is compiled in the first call
+    pop.step(dt,dt,box_size,inf_spec,recov_spec,dead_spec,None,search)
+    start = timer()
+    for s in range(steps):
+        time = (s+2)*dt
+        pop.step(dt,time,box_size,inf_spec,recov_spec,dead_spec,None,search)
+    return (timer()-start)/steps
+
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('numba available: '+str(numba_flag))
+    print('%10s %12s %12s %12s %10s'%('subjects','tuple [ms]','array [ms]','jit [ms]','jit/array'))
+    for num in [10**4,10**5,10**6]:
+        # the tuple engine is too slow to be measured at 1M subjects
+        t_tuple = bench_tuple(num,steps) if num <= 10**5 else np.nan
+        t_array = bench_population(Population,num,steps)
+        t_jit = bench_population(JitPopulation,num,steps)
+        print('%10d %12.2f %12.2f %12.2f %9.1fx'%(num,1e3*t_tuple,1e3*t_array,1e3*t_jit,t_array/t_jit))
@@ -0,0 +1,53 @@
+import os,sys,shutil,tempfile
+import numpy as np
+from pandsim import PandemicSimulation
+from core_numba import numba_flag
+
+
+################################################
+#                                              #
+#       Check of the checkpoint and resume     #
+#                                              #
+################################################
+
+
+_keys = ['Health','Ill','Recovered','Dead']
+
+
+def check_resume(engine,steps=170,every=60,seed=7):
+    """
+    Run the simulation with checkpoints, resume it from the last checkpoint in another
+    folder and compare the statistics with the uninterrupted run. The box is small
+    enough that subjects are still infected after the checkpoint
+    
+    Output
+    ------
+    identical: the resumed run gives the same statistics
+    infected: number of infections after the checkpoint
+    """
+    spec = dict(n_ill=200,n_health=5000,steps=steps,seed=seed,engine=engine,search='cell',
+                box_size=[[-300,300],[-300,300]])
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    try:
+        os.chdir(folder)
+        full = PandemicSimulation(disease_name='full',checkpoint_every=every,**spec)
+        shutil.copy('full/full_checkpoint.npz','checkpoint.npz')
+        step = int(np.load('checkpoint.npz')['step'])
+        resumed = PandemicSimulation(disease_name='resumed',resume_from='checkpoint.npz',**spec)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    identical = all(np.array_equal(full[key],resumed[key]) for key in _keys)
+    return identical,int(full['Health'][step]-full['Health'][-1])
+
+
+if __name__ == '__main__':
+    engines = ['tuple','array','jit'] if numba_flag else ['tuple','array']
+    results = {engine:check_resume(engine) for engine in engines}
+    print('%8s %10s %24s'%('engine','identical','infections after resume'))
+    for engine,(identical,infected) in results.items():
+        print('%8s %10s %24d'%(engine,identical,infected))
+    if not all(identical and infected > 0 for identical,infected in results.values()):
+        sys.exit(1)
+    else: pass
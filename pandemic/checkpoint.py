@@ -0,0 +1,144 @@
+import os,json,threading
+import numpy as np
+
+
+################################################
+#                                              #
+#              Checkpoint and resume           #
+#                                              #
+################################################
+
+
+def rng_state(rng):
+    """
+    The state of the random source as a json string, rng is the np.random module
+    for the global state or a numpy.random.Generator
+    """
+    if rng is np.random:
+        state = np.random.get_state(legacy=False)
+    else:
+        state = rng.bit_generator.state
+    return json.dumps(state,default=lambda x: x.tolist())
+
+
+def set_rng_state(rng,state):
+    """
+    Restore the state saved by rng_state
+    """
+    state = json.loads(state)
+    if rng is np.random:
+        state['state']['key'] = np.asarray(state['state']['key'],dtype=np.uint32)
+        np.random.set_state(state)
+    elif state['bit_generator'] != type(rng.bit_generator).__name__:
+        raise ValueError('The checkpoint has the random state of '+state['bit_generator']
+                         +' but the run uses '+type(rng.bit_generator).__name__)
+    else:
+        if state['bit_generator'] == 'MT19937':
+            state['state']['key'] = np.asarray(state['state']['key'],dtype=np.uint32)
+        else: pass
+        rng.bit_generator.state = state
+
+
+def save_checkpoint(path,state):
+    """
+    Write the dict of arrays state to the .npz file path atomically, the file is
+    written aside and renamed over path, hence path always holds a complete checkpoint
+    """
+    tmp = path+'.tmp'
+    with open(tmp,'wb') as f:
+        np.savez(f,**state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
+
+
+def load_checkpoint(path):
+    """
+    Load the checkpoint written by save_checkpoint as a dict of arrays
+    """
+    with np.load(path) as f:
+        return {key:f[key] for key in f.files}
+
+
+class Checkpointer:
+    """
+    Periodic checkpoints written on a background thread. The state is copied when it
+    is submitted and written while the simulation goes on, if the writer is still busy
+    only the latest state is kept for the next write
+    
+    Input
+    ------
+    path: the .npz file of the checkpoint
+    every: number of steps between the checkpoints
+    """
+    
+    def __init__(self,path,every):
+        if type(every) == int and every > 0:
+            pass
+        else:
+            raise ValueError('The checkpoint interval should be a positive integer')
+        self.path = path
+        self.every = every
+        self._next = every
+        self._pending = None
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work,daemon=True)
+        self._thread.start()
+    
+    def due(self,step):
+        """
+        Is a checkpoint due after step steps, a macro step may pass several at once
+        """
+        if step < self._next:
+            return False
+        else:
+            self._next = (step//self.every+1)*self.every
+            return True
+    
+    def submit(self,state):
+        """
+        Queue a copy of the dict of arrays state to be written
+        """
+        self._raise()
+        state = {key:np.array(value,copy=True) for key,value in state.items()}
+        with self._cond:
+            self._pending = state
+            self._cond.notify()
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                else: pass
+                state,self._pending = self._pending,None
+            try:
+                save_checkpoint(self.path,state)
+            except Exception as error:
+                self._error = error
+    
+    def _raise(self):
+        if self._error is not None:
+            error,self._error = self._error,None
+            raise error
+        else: pass
+    
+    def close(self):
+        """
+        Write the pending checkpoint and stop the background thread
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._raise()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
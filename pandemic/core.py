@@ -1,6 +1,9 @@
-import sys,cv2,os
+import sys,os
 import numpy as np
-from scipy.stats import truncnorm,norm
+from sampler import get_rng,truncnorm_lower
+from scheduler import EventQueue
+from store import TrajectoryWriter
+from checkpoint import rng_state,set_rng_state
 
 
 ################################################
@@ -10,7 +13,7 @@ from scipy.stats import truncnorm,norm
 ################################################
 
 
-def init_health(prange=[[0,50],[0,50]],vrange=[0.5,5],num=100):
+def init_health(prange=[[0,50],[0,50]],vrange=[0.5,5],num=100,rng=None):
     """
     Generate the initial positions and velocities for the healthy subjects
     
@@ -19,29 +22,31 @@ def init_health(prange=[[0,50],[0,50]],vrange=[0.5,5],num=100):
     prange: the boundary of the initial healthy subjects reside
     vrange: the range of the velocity
     num: number of subjects
+    rng: the random source, None for the global np.random state, see sampler.get_rng
     
     Output
     ------
     tuple: containing position and velocity arrays, both are (2,num) arrays
     """
+    rng = get_rng(rng)
     # Range of (x,y) and velocity
     xr,yr=np.asarray(prange)
     vrange=np.asarray(vrange)
     
     # Generate positions
-    x = np.random.uniform(xr[0],xr[1],size=num)
-    y = np.random.uniform(yr[0],yr[1],size=num)
+    x = rng.uniform(xr[0],xr[1],size=num)
+    y = rng.uniform(yr[0],yr[1],size=num)
     
     # Generate velocities
-    init_v = np.random.uniform(vrange[0],vrange[1],size=num)
-    init_theta = np.random.uniform(0,2*np.pi,size=num)
+    init_v = rng.uniform(vrange[0],vrange[1],size=num)
+    init_theta = rng.uniform(0,2*np.pi,size=num)
     x_v = init_v*np.cos(init_theta)
     y_v = init_v*np.sin(init_theta)
     
     return np.asarray([x,y]),np.asarray([x_v,y_v])
 
 
-def init_ill(recov_spec,dead_spec,prange=[[0,50],[0,50]],vrange=[0.5,5],num=1):
+def init_ill(recov_spec,dead_spec,prange=[[0,50],[0,50]],vrange=[0.5,5],num=1,rng=None):
     """
     Generate the initial postions and velocities for the ill subjects
     
@@ -52,6 +57,7 @@ def init_ill(recov_spec,dead_spec,prange=[[0,50],[0,50]],vrange=[0.5,5],num=1):
     prange: the boundary of the initial ill subjects reside
     vrange: the range of the velocity
     num: number of subjects
+    rng: the random source, see sampler.get_rng
     
     Output
     ------
@@ -59,21 +65,9 @@ def init_ill(recov_spec,dead_spec,prange=[[0,50],[0,50]],vrange=[0.5,5],num=1):
            infected, the first two are (2,num) and the last is (num,) array
     """
     # Generate the positions and velocities of the ill subjects from function init_health
-    ill_pos,ill_v = init_health(prange,vrange,num)
-    # Generate empty array to store the time stamp that will triger the subject to recover
-    # or die in the future
-    fut_time = np.zeros(num)
-    
+    ill_pos,ill_v = init_health(prange,vrange,num,rng)
     # Generate the array of being infected, the initial ills have t_inf = 0
-    recov_time = recovery(num,0,recov_spec)
-    dead_time = dead(num,0,dead_spec)
-    
-    # Determine which index will recover, 1 will recover; 0 will die
-    fut_stat = (recov_time < dead_time)*1
-    # The corresponding time stamp to recover
-    fut_time[recov_time<dead_time] = recov_time[recov_time<dead_time]
-    # The corresponding time stamp to die
-    fut_time[recov_time>dead_time] = dead_time[recov_time>dead_time]
+    fut_stat,fut_time = fut_status(num,0,recov_spec,dead_spec,rng)
     
     return ill_pos,ill_v,np.array([fut_stat,fut_time])
 
@@ -137,6 +131,216 @@ def next_pos_v(pos,vel,box_size,dt):
     return next_pos,vel
 
 
+def next_pos_v_inplace(pos,vel,box_size,dt,work=None):
+    """
+    In-place version of next_pos_v, updating the caller owned position and velocity
+    arrays without allocation. The subjects travelling further than the box width
+    in a single step are folded back with the correct number of bounces
+    
+    Input
+    -----
+    pos: positions of n-th subjects, a (2,n) float array, or (...,2,n) for stacked populations
+    vel: velocities of n-th subjects, the same shape as pos
+    box_size: an (2,2) array, the boundary of the simulation box
+    dt: the size of simulation time step
+    work: scratch array with the same shape as pos, allocated if None
+    
+    Output
+    ------
+    tuple: the same pos and vel arrays, updated
+    """
+    if work is None:
+        work = np.empty_like(pos)
+    else: pass
+    
+    # Calculate the next position
+    np.multiply(vel,dt,out=work)
+    np.add(pos,work,out=pos)
+    
+    for axis in range(2):
+        b_min,b_max = box_size[axis]
+        width = b_max-b_min
+        x = pos[...,axis,:]
+        v = vel[...,axis,:]
+        w = work[...,axis,:]
+        # The largest displacement of this axis decides the folding, the remainder is
+        # about 40 times slower than the plain arithmetic
+        single = np.abs(w,out=w).max(initial=0) < width
+        np.subtract(x,b_min,out=x)
+        if single:
+            # Distance to b_min in (-width,2*width), at most one bounce which reverses
+            # the velocity when the subject leaves [0,width]
+            np.subtract(x,width/2,out=w)
+            np.abs(w,out=w)
+            np.greater_equal(w,width/2,out=w)
+        else:
+            # Distance to b_min folded into [0,2*width), every box width travelled beyond
+            # the box is one bounce, an odd number of bounces ends in the upper half
+            np.remainder(x,2*width,out=x)
+            np.greater_equal(x,width,out=w)
+        # Reverse the velocity of the odd number of bounces
+        np.multiply(w,-2,out=w)
+        np.add(w,1,out=w)
+        np.multiply(v,w,out=v)
+        if single:
+            # width-|width-|x|| mirrors both sides back into the box
+            np.abs(x,out=x)
+            np.subtract(width,x,out=x)
+            np.abs(x,out=x)
+            np.subtract(width,x,out=x)
+        else:
+            # The upper half is mirrored back into the box
+            np.subtract(2*width,x,out=w)
+            np.minimum(x,w,out=x)
+        np.add(x,b_min,out=x)
+    
+    return pos,vel
+
+
+################################################
+#                                              #
+#               Neighbor search                #
+#                                              #
+################################################
+
+
+def _empty_pairs():
+    return np.array([],dtype=np.int64),np.array([],dtype=np.int64)
+
+
+def _pairs_brute(ill,health,r_inf):
+    """
+    Compare every ill subject with all the healthy subjects, O(N_ill*N_health)
+    """
+    ill_idx,health_idx = [],[]
+    for i in range(len(ill[0])):
+        # Calculate the distance between the healthy subjects and the ill one
+        r = np.sqrt(np.sum((ill[:,i].reshape(2,1)-health)**2,axis=0))
+        near = np.where(r<r_inf)[0]
+        ill_idx.append(np.full(near.size,i,dtype=np.int64))
+        health_idx.append(near.astype(np.int64))
+    return np.concatenate(ill_idx),np.concatenate(health_idx)
+
+
+def _pairs_cell(ill,health,r_inf):
+    """
+    Uniform grid cell list with cells no smaller than r_inf and about as many as the
+    subjects, only the subjects in the 3x3 cells around each other are compared
+    """
+    # Put the origin of the grid at the lower-left corner of all subjects
+    origin = np.minimum(ill.min(axis=1),health.min(axis=1))
+    extent = np.maximum(ill.max(axis=1),health.max(axis=1))-origin
+    cell = max(r_inf,np.sqrt(extent[0]*extent[1]/(len(ill[0])+len(health[0]))))
+    # the extra one cell margin keeps the neighboring cell keys from aliasing, one
+    # more cell covers the rounding of the cell index of the farthest subject
+    ny = int(extent[1]/cell)+4
+    n_keys = (int(extent[0]/cell)+4)*ny
+    def _key(pos):
+        return ((pos[0]-origin[0])*(1/cell)).astype(np.int64)*ny \
+               +((pos[1]-origin[1])*(1/cell)).astype(np.int64)+ny+1
+    ill_idx,health_idx = _cell_scan(_key(ill),_key(health),n_keys,ny)
+    
+    # Keep the candidates that are really within r_inf
+    r2 = np.sum((ill[:,ill_idx]-health[:,health_idx])**2,axis=0)
+    near = r2 < r_inf**2
+    return ill_idx[near],health_idx[near]
+
+
+def _cell_scan(key_ill,key_health,n_keys,ny):
+    """
+    Candidate pairs of the ill and the healthy subjects in neighboring cells, the key
+    of the cell (x,y) is x*ny+y in [0,n_keys) with an empty margin around the occupied
+    cells. The smaller group is counting-sorted by the key, hence each neighboring
+    column of 3 cells is a range read from the cell offsets without a binary search.
+    Only the subjects of the larger group next to the smaller group are scanned
+    
+    Output
+    ------
+    tuple: the indices of the ill and the healthy subjects in each candidate pair
+    """
+    swap = len(key_ill) < len(key_health)
+    key_scan,key_sorted = (key_health,key_ill) if swap else (key_ill,key_health)
+    # the order within a cell does not matter, the pairs are reduced to a set
+    order = np.argsort(key_sorted)
+    # the subjects in the cell k are order[start[k]:start[k+1]]
+    start = np.zeros(n_keys+1,dtype=np.int64)
+    np.cumsum(np.bincount(key_sorted,minlength=n_keys),out=start[1:])
+    # the subjects of the larger group within the 3x3 cells around the smaller group
+    near_cell = np.zeros(n_keys,dtype=bool)
+    for dx in (-1,0,1):
+        for dy in (-1,0,1):
+            near_cell[key_sorted+dx*ny+dy] = True
+    scan = np.flatnonzero(near_cell[key_scan])
+    key_scan = key_scan[scan]
+    
+    # The cells (x+dx,y-1), (x+dx,y) and (x+dx,y+1) are consecutive keys, each column
+    # of the 3x3 neighborhood is a single range
+    scan_idx,sorted_idx = [np.array([],dtype=np.int64)],[np.array([],dtype=np.int64)]
+    for dx in (-1,0,1):
+        column = key_scan+dx*ny
+        lo,hi = start[column-1],start[column+2]
+        count = hi-lo
+        total = count.sum()
+        if total == 0:
+            continue
+        # Expand the ranges into the candidate pairs
+        first = np.repeat(lo-np.cumsum(count)+count,count)
+        scan_idx.append(np.repeat(np.arange(len(count)),count))
+        sorted_idx.append(order[first+np.arange(total)])
+    scan_idx,sorted_idx = scan[np.concatenate(scan_idx)],np.concatenate(sorted_idx)
+    return (sorted_idx,scan_idx) if swap else (scan_idx,sorted_idx)
+
+
+def _pairs_kdtree(ill,health,r_inf):
+    """
+    Ball query between the k-d trees of the ill and the healthy subjects
+    """
+    from scipy.spatial import cKDTree
+    
+    pairs = cKDTree(ill.T).sparse_distance_matrix(cKDTree(health.T),r_inf,output_type='ndarray')
+    # The query includes the pairs with distance equals to r_inf
+    pairs = pairs[pairs['v'] < r_inf]
+    return pairs['i'].astype(np.int64),pairs['j'].astype(np.int64)
+
+
+_search_backends = {'brute':_pairs_brute,
+                    'cell':_pairs_cell,
+                    'kdtree':_pairs_kdtree}
+
+
+def contact_pairs(ill,health,r_inf,search='brute'):
+    """
+    Find all the ill-healthy pairs with the distance smaller than r_inf
+    
+    Input
+    ------
+    ill: ill subjects' positions, a (2,n_ill) array
+    health: healthy subjects' positions, a (2,n_health) array
+    r_inf: the infectious radius
+    search: the neighbor search backend
+            'brute': compare each ill subject with all the healthy subjects
+            'cell': uniform grid cell list, the cells are no smaller than r_inf
+            'kdtree': ball query with scipy cKDTree
+    
+    Output
+    ------
+    tuple: the indices of the ill and the healthy subjects in each pair, sorted
+           by the ill index first and then by the healthy index
+    """
+    if search not in _search_backends:
+        raise ValueError('Unknown search backend \''+str(search)+'\', should be one of '
+                         +str(list(_search_backends)))
+    else: pass
+    
+    if len(ill[0]) == 0 or len(health[0]) == 0:
+        return _empty_pairs()
+    else: pass
+    
+    ill_idx,health_idx = _search_backends[search](ill,health,r_inf)
+    order = np.lexsort((health_idx,ill_idx))
+    return ill_idx[order],health_idx[order]
+
+
 ################################################
 #                                              #
 #                Sampling core                 #
@@ -144,7 +348,7 @@ def next_pos_v(pos,vel,box_size,dt):
 ################################################
 
 
-def infected(ill,health,vh,dt,ill_spec,mask_protect=None):
+def infected(ill,health,vh,dt,ill_spec,mask_protect=None,search='brute',rng=None):
     """
     Determined which healthy subjects will be infected in this step.
     
@@ -156,23 +360,37 @@ def infected(ill,health,vh,dt,ill_spec,mask_protect=None):
     ill_spec: [r_inf,t_avg,t_std]
     mask_protect: the protectability of wearing a facial mask.
                   Default is None for no mask is wearing. Input value between 0 and 1
+    search: the neighbor search backend, 'brute', 'cell' or 'kdtree', see contact_pairs
+    rng: the random source, see sampler.get_rng
     
     Return
     ------
     array: the indices of the healthy subjects' array that are infected in this step
     """
-    num_ill = len(ill[0])
-    r_inf,t_avg,t_std = ill_spec
-    
+    r_inf = _mask_radius(ill_spec[0],mask_protect)
+    # Find which healthy subjects' having the distance to the ill is smaller than r_inf
+    ill_idx,health_idx = contact_pairs(ill,health,r_inf,search)
+    return _infected_contacts(health_idx,len(health[0]),vh,dt,r_inf,ill_spec,rng)
+
+
+def _mask_radius(r_inf,mask_protect):
+    """
+    The infectious radius shrunk by the mask protectability
+    """
     if mask_protect is None:
-        pass
+        return r_inf
     elif mask_protect < 1:
         raise ValueError('The mask protectability should be larger than 1')
     else:
-        r_inf = r_inf/mask_protect
-    
-    # Empty array to store which subjects will be infected in this step
-    new_ill = np.zeros_like(health[0])
+        return r_inf/mask_protect
+
+
+def _infected_contacts(health_idx,n_health,vh,dt,r_inf,ill_spec,rng=None):
+    """
+    Sample the infected among the healthy subjects health_idx of the contact pairs,
+    see infected
+    """
+    t_avg,t_std = ill_spec[1:]
     
     # Probability function
     def _sampling_infected(vh,dt):
@@ -186,34 +404,34 @@ def infected(ill,health,vh,dt,ill_spec,mask_protect=None):
         t_pass[t_pass>dt] = dt
         
         # How much time is needed for this subject to be infected
-        t_inf = truncnorm.rvs(-t_avg/t_std,np.inf,loc=t_avg,scale=t_std,size=num)
+        t_inf = truncnorm_lower(t_avg,t_std,num,rng)
         # If t_pass > t_inf, the subject will be infected because it stays in the infectious zone too long
-        return (t_pass > t_inf)*1
+        return t_pass > t_inf
     
-    for i in range(num_ill):
-        # Calculate the distance between the healthy subjects and the ill one
-        r = np.sqrt(np.sum((ill[:,i].reshape(2,1)-health)**2,axis=0))
-        # Find which healthy subjects' having the distance to the ill is smaller than r_inf
-        high_prob_index = np.where(r<r_inf)[0]
-        if high_prob_index.size == 0:
-            # No one stands in the place where the distance is smaller than r_inf
-            pass
-        else:
-            # Sampling which high_prob subject is infected
-            is_ill = _sampling_infected(vh[:,high_prob_index],dt)
-            # Set the corresponding index in the new_ill array 1
-            new_ill[high_prob_index] = is_ill
-            
-    return np.where(new_ill==1)[0]
+    if health_idx.size == 0:
+        # No one stands in the place where the distance is smaller than r_inf
+        return health_idx
+    else: pass
+    
+    # Reduce the pairs to the healthy subjects standing close to any ill subject.
+    # t_pass only depends on the healthy subject and every pair draws an independent
+    # t_inf where the last ill neighbor decides the outcome, hence a single draw per
+    # healthy subject follows the same distribution
+    high_prob_index = np.flatnonzero(np.bincount(health_idx,minlength=n_health))
+    # Sampling which high_prob subject is infected, all in one batch
+    is_ill = _sampling_infected(vh[:,high_prob_index],dt)
+    
+    return high_prob_index[is_ill]
 
 
-def dead(num,time,death_spec):
+def dead(num,time,death_spec,rng=None):
     """
     Determined the time stamp that the subject will die
     
     num: how many subjects' death time want to generate
     time: current time stamp
     death_spec: [t_avg,t_std]
+    rng: the random source, see sampler.get_rng
     
     Return
     ------
@@ -222,21 +440,22 @@ def dead(num,time,death_spec):
     t_avg,t_std = death_spec
     
     # Get the rest hours that the subject can still live
-    # I use truncnorm to truncate the random variate between (0,np.inf) 
-    rest_time = truncnorm.rvs(a=-t_avg/t_std,b=np.inf,loc=t_avg,scale=t_std,size=num)
+    # The random variate is truncated between (0,np.inf)
+    rest_time = truncnorm_lower(t_avg,t_std,num,rng)
     # Mark when time stamp that the subject will die
     dead_time = time + rest_time
     
     return dead_time
 
 
-def recovery(num,time,recov_spec):
+def recovery(num,time,recov_spec,rng=None):
     """
     Determined the time stamp that the subject will recover
     
     num: how many subjects' recovery time want to generate
     time: the current time stamp
     recov_spec: [t_avg,t_std]
+    rng: the random source, see sampler.get_rng
     
     Return
     ------
@@ -245,14 +464,47 @@ def recovery(num,time,recov_spec):
     t_avg,t_std = recov_spec
     
     # Get how many hours that the subject needs to recover
-    # I use truncnorm to truncate the random variate between (0,np.inf) 
-    need_time = truncnorm.rvs(a=-t_avg/t_std,b=np.inf,loc=t_avg,scale=t_std,size=num)
+    # The random variate is truncated between (0,np.inf)
+    need_time = truncnorm_lower(t_avg,t_std,num,rng)
     # Mark when time stamp that the subject will die
     recov_time = time + need_time
     
     return recov_time
 
 
+def fut_status(num,time,recov_spec,death_spec,rng=None):
+    """
+    Determined the future of the newly infected subjects, to recover or to die
+    
+    num: how many newly infected subjects
+    time: the current time stamp
+    recov_spec: [t_avg,t_std]
+    death_spec: [t_avg,t_std]
+    rng: the random source, see sampler.get_rng
+    
+    Return
+    ------
+    tuple: the (num,) arrays of the future status, 1 will recover; 0 will die, and
+           the corresponding time stamps
+    """
+    # Generate empty array to store the time stamp that will triger the subject to recover
+    # or die in the future
+    fut_time = np.zeros(num)
+    
+    # Time of recovery and die
+    recov_time = recovery(num,time,recov_spec,rng)
+    dead_time = dead(num,time,death_spec,rng)
+    
+    # Determine which index will recover, 1 will recover; 0 will die
+    fut_stat = (recov_time < dead_time)*1
+    # The corresponding time stamp to recover
+    fut_time[recov_time<dead_time] = recov_time[recov_time<dead_time]
+    # The corresponding time stamp to die
+    fut_time[recov_time>dead_time] = dead_time[recov_time>dead_time]
+    
+    return fut_stat,fut_time
+
+
 def sub_stat(ill,health,recov,death,
              ill_v,health_v,recov_v,
              t_ill,
@@ -260,7 +512,9 @@ def sub_stat(ill,health,recov,death,
              ill_spec,
              recov_spec,
              death_spec,
-             mask_protect=None):
+             mask_protect=None,
+             search='brute',
+             rng=None):
     """
     Update the status of the infected and non-infected subject at this interval
     
@@ -280,6 +534,8 @@ def sub_stat(ill,health,recov,death,
     recov_spec: the specs of getting recovered [t_r_avg,t_r_std]
     death_spec: the specs of dying [t_d_avg,t_d_std]
     mask_protect: the protectability of wearing a mask
+    search: the neighbor search backend for infection, see contact_pairs
+    rng: the random source, see sampler.get_rng
     
     Output
     ------
@@ -340,7 +596,7 @@ def sub_stat(ill,health,recov,death,
             t_ill = np.delete(t_ill,who_is_recovered,axis=1)
     
     # Find the array index of the non_inf is infected in this step
-    get_ill = infected(ill,health,health_v,dt,ill_spec,mask_protect)
+    get_ill = infected(ill,health,health_v,dt,ill_spec,mask_protect,search,rng)
     # Deal with the new_infect
     if get_ill.size == 0:
         # no subject is infected in this interval, pass
@@ -357,17 +613,8 @@ def sub_stat(ill,health,recov,death,
         ill = np.append(ill,new_ill,axis=1)
         ill_v = np.append(ill_v,new_ill_v,axis=1)
         
-        # Time of recovery and die
-        recov_time = recovery(new_ill_num,current_time,recov_spec)
-        dead_time = dead(new_ill_num,current_time,death_spec)
-        
-        # Determine which index will recover, 1 will recover; 0 will die
-        fut_time = np.zeros(new_ill_num)
-        fut_stat = (recov_time < dead_time)*1
-        # The corresponding time stamp to recover
-        fut_time[recov_time<dead_time] = recov_time[recov_time<dead_time]
-        # The corresponding time stamp to die
-        fut_time[recov_time>dead_time] = dead_time[recov_time>dead_time]
+        # Time of recovery or die
+        fut_stat,fut_time = fut_status(new_ill_num,current_time,recov_spec,death_spec,rng)
         
         # Append to t_ill
         t_ill = np.append(t_ill,np.array([fut_stat,fut_time]),axis=1)
@@ -379,6 +626,338 @@ def sub_stat(ill,health,recov,death,
     return ill,health,recov,death,ill_v,health_v,recov_v,t_ill
 
 
+################################################
+#                                              #
+#              State-array engine              #
+#                                              #
+################################################
+
+
+# Status codes of the subjects in the state-array engine
+HEALTH,ILL,RECOVERED,DEAD = 0,1,2,3
+# The state arrays saved in the checkpoints
+_population_keys = ['pos','vel','status','fut_stat','fut_time']
+
+
+class Population:
+    """
+    All subjects live in the same preallocated arrays and the transitions between
+    ill, healthy, recovered and dead are status updates without reallocation
+    
+    pos: positions of all subjects, a (2,N) array
+    vel: velocities of all subjects, a (2,N) array, zero for the dead
+    status: the (N,) int8 array of HEALTH, ILL, RECOVERED or DEAD
+    fut_stat: the (N,) int8 array of the ill subjects' future, 1 will recover; 0 will die
+    fut_time: the (N,) array of the time stamps to recover or die, inf if not ill
+    events: the EventQueue of the pending recoveries and deaths
+    rng: the random source of the infections and the transitions, see sampler.get_rng
+    """
+    
+    def __init__(self,xi,xh,vi,vh,ti,rng=None):
+        n_ill = len(xi[0])
+        num = n_ill+len(xh[0])
+        self.pos = np.empty((2,num))
+        self.vel = np.empty((2,num))
+        self.pos[:,:n_ill],self.pos[:,n_ill:] = xi,xh
+        self.vel[:,:n_ill],self.vel[:,n_ill:] = vi,vh
+        self.status = np.full(num,HEALTH,dtype=np.int8)
+        self.status[:n_ill] = ILL
+        self.fut_stat = np.zeros(num,dtype=np.int8)
+        self.fut_stat[:n_ill] = ti[0]
+        self.fut_time = np.full(num,np.inf)
+        self.fut_time[:n_ill] = ti[1]
+        # scratch array of the kinematics
+        self._work = np.empty((2,num))
+        self.events = EventQueue()
+        self.events.push(np.arange(n_ill),ti[1])
+        self.rng = get_rng(rng)
+        # back-off of the quiet_steps check while the contacts are dense
+        self._quiet_wait,self._quiet_skip = 0,1
+    
+    def step(self,dt,current_time,box_size,ill_spec,recov_spec,death_spec,
+             mask_protect=None,search='brute'):
+        """
+        Update the status, positions and velocities of all subjects at this interval,
+        the arguments are the same as sub_stat
+        """
+        # Whose times up in this step
+        due = self.events.pop(current_time)
+        self.fut_time[due] = np.inf
+        # The dead stop moving
+        is_dead = due[self.fut_stat[due] == 0]
+        self.status[is_dead] = DEAD
+        self.vel[:,is_dead] = 0
+        self.status[due[self.fut_stat[due] == 1]] = RECOVERED
+        
+        # Find the healthy subjects infected in this step
+        ill = np.flatnonzero(self.status == ILL)
+        health = np.flatnonzero(self.status == HEALTH)
+        get_ill = infected(self.pos[:,ill],self.pos[:,health],self.vel[:,health],dt,
+                           ill_spec,mask_protect,search,self.rng)
+        if get_ill.size == 0:
+            # no subject is infected in this interval, pass
+            pass
+        else:
+            get_ill = health[get_ill]
+            self.status[get_ill] = ILL
+            self.fut_stat[get_ill],self.fut_time[get_ill] = fut_status(get_ill.size,current_time,
+                                                                       recov_spec,death_spec,
+                                                                       self.rng)
+            self.events.push(get_ill,self.fut_time[get_ill])
+        
+        # Update positions and velocities in a single pass, the dead have zero velocity and stay
+        next_pos_v_inplace(self.pos,self.vel,np.asarray(box_size),dt,self._work)
+    
+    def quiet_steps(self,dt,current_time,ill_spec,mask_protect=None,max_steps=1):
+        """
+        Number of the steps from current_time, at most max_steps, in which no healthy
+        subject can come within r_inf of an ill one and no recovery or death falls
+        after the first step, hence the steps can be taken as a single move
+        """
+        if max_steps <= 1:
+            return 1
+        elif self._quiet_wait > 0:
+            # the last check found contacts within reach, do not check every step
+            self._quiet_wait -= 1
+            return 1
+        else: pass
+        r_inf = ill_spec[0] if mask_protect is None else ill_spec[0]/mask_protect
+        
+        # The transitions due at current_time are taken in the first step,
+        # the next one limits the jump
+        next_time = self.fut_time[self.fut_time >= current_time].min(initial=np.inf)
+        num = max_steps if np.isinf(next_time) else (next_time-current_time)//dt
+        
+        # The distance of a healthy subject to its nearest ill one shrinks by at most
+        # (v_ill_max+v_health)*t after time t, the reflections on the walls do not
+        # change the speed
+        ill = self.status == ILL
+        health = self.status == HEALTH
+        if ill.any() and health.any():
+            from scipy.spatial import cKDTree
+            
+            d = cKDTree(self.pos[:,ill].T).query(self.pos[:,health].T)[0]
+            speed = np.sqrt(np.sum(self.vel**2,axis=0))
+            v_close = speed[ill].max()+speed[health]
+            if d.min() < r_inf:
+                num = 0
+            elif v_close.max() > 0:
+                num = min(num,np.min((d-r_inf)/np.maximum(v_close,1e-300))//dt)
+            else: pass
+        else: pass
+        
+        num = int(max(min(num,max_steps),1))
+        if num == 1:
+            self._quiet_skip = min(2*self._quiet_skip,64)
+            self._quiet_wait = self._quiet_skip
+        else:
+            self._quiet_skip = 1
+        return num
+    
+    def advance(self,dt,current_time,box_size,ill_spec,recov_spec,death_spec,
+                mask_protect=None,search='brute',max_steps=1):
+        """
+        Take a fine step of dt while contacts are possible, otherwise a macro step of
+        several dt at once, see quiet_steps. No infection can happen in a macro step,
+        so it is the same as taking the steps one by one. Returns the number of steps
+        """
+        num = self.quiet_steps(dt,current_time,ill_spec,mask_protect,max_steps)
+        self.step(num*dt,current_time,box_size,ill_spec,recov_spec,death_spec,mask_protect,search)
+        return num
+    
+    def next_event_time(self):
+        """
+        The time stamp of the next recovery or death, inf if nobody is ill
+        """
+        return self.events.next_time()
+    
+    def load_state(self,state):
+        """
+        Restore the state arrays, eg. from a checkpoint, a dict of pos, vel, status,
+        fut_stat and fut_time. The pending events are rebuilt from fut_time
+        """
+        for key in _population_keys:
+            setattr(self,key,np.array(state[key],dtype=getattr(self,key).dtype))
+        self._work = np.empty_like(self.pos)
+        ill = np.flatnonzero(self.status == ILL)
+        self.events = EventQueue()
+        self.events.push(ill,self.fut_time[ill])
+    
+    def counts(self):
+        """
+        Number of the healthy, ill, recovered and dead subjects
+        """
+        return np.bincount(self.status,minlength=4)
+    
+    def views(self):
+        """
+        The compatibility view with the tuple API of Subject.run, xi,xh,xr,xd,vi,vh,vr,ti
+        """
+        ill = self.status == ILL
+        health = self.status == HEALTH
+        recov = self.status == RECOVERED
+        ti = np.array([self.fut_stat[ill],self.fut_time[ill]])
+        return (self.pos[:,ill],self.pos[:,health],self.pos[:,recov],self.pos[:,self.status == DEAD],
+                self.vel[:,ill],self.vel[:,health],self.vel[:,recov],ti)
+
+
+def _replica_pairs(pos,ill,health,box_size,r_inf):
+    """
+    Contact pairs of the ill and the healthy subjects of the same replica on a dense
+    cell grid of each replica's box. The cells are no smaller than r_inf and about as
+    many as the subjects of a replica, the pairs are scanned by _cell_scan
+    
+    Input
+    ------
+    pos: the (R,2,N) positions of all replicas
+    ill,health: the (replica,subject) indices of the ill and the healthy subjects
+    box_size: an (2,2) array, the boundary of the simulation box
+    r_inf: the infectious radius
+    
+    Output
+    ------
+    tuple: the indices into ill and health of the pairs within r_inf
+    """
+    replicas,num = pos.shape[0],pos.shape[-1]
+    width = box_size[:,1]-box_size[:,0]
+    cell = max(r_inf,np.sqrt(width[0]*width[1]/num))
+    n_cells = (width//cell).astype(np.int64)+1
+    # one cell of margin on each side, the neighbors never alias across the rows or
+    # the replicas
+    nx,ny = n_cells+2
+    cx = ((pos[:,0]-box_size[0,0])*(1/cell)).astype(np.int64)
+    cy = ((pos[:,1]-box_size[1,0])*(1/cell)).astype(np.int64)
+    np.clip(cx,0,n_cells[0]-1,out=cx)
+    np.clip(cy,0,n_cells[1]-1,out=cy)
+    key = (np.arange(replicas)[:,None]*nx+cx+1)*ny+cy+1
+    
+    ill_idx,health_idx = _cell_scan(key[ill],key[health],replicas*nx*ny,ny)
+    
+    # Keep the candidates that are really within r_inf
+    rep,sub = ill[0][ill_idx],ill[1][ill_idx]
+    r2 = np.sum((pos[rep,:,sub]-pos[health[0][health_idx],:,health[1][health_idx]])**2,axis=1)
+    near = r2 < r_inf**2
+    return ill_idx[near],health_idx[near]
+
+
+class ReplicaPopulation:
+    """
+    R independent replicas of the Population advanced together, the replicas are an
+    extra leading axis of the state arrays so that one vectorized step serves all of them.
+    The contacts of all replicas are found at once on the cell grid of _replica_pairs
+    
+    pos: positions, a (R,2,N) array
+    vel: velocities, a (R,2,N) array, zero for the dead
+    status: the (R,N) int8 array of HEALTH, ILL, RECOVERED or DEAD
+    fut_stat: the (R,N) int8 array of the ill subjects' future, 1 will recover; 0 will die
+    fut_time: the (R,N) array of the time stamps to recover or die, inf if not ill
+    events: the EventQueue of the pending recoveries and deaths, keyed on the flat
+            index replica*N+subject
+    rng: the random source shared by the replicas, see sampler.get_rng
+    """
+    
+    def __init__(self,xi,xh,vi,vh,ti,rng=None):
+        """
+        xi,xh,vi,vh are the (R,2,n) stacked positions and velocities of the ill and the
+        healthy subjects and ti is the (R,2,n_ill) stacked future status and time stamps
+        """
+        n_ill = xi.shape[-1]
+        self.pos = np.concatenate([xi,xh],axis=-1)
+        self.vel = np.concatenate([vi,vh],axis=-1)
+        replicas,num = self.pos.shape[0],self.pos.shape[-1]
+        self.status = np.full((replicas,num),HEALTH,dtype=np.int8)
+        self.status[:,:n_ill] = ILL
+        self.fut_stat = np.zeros((replicas,num),dtype=np.int8)
+        self.fut_stat[:,:n_ill] = ti[:,0]
+        self.fut_time = np.full((replicas,num),np.inf)
+        self.fut_time[:,:n_ill] = ti[:,1]
+        # scratch array of the kinematics
+        self._work = np.empty_like(self.pos)
+        self._new_events()
+        self.rng = get_rng(rng)
+    
+    def _new_events(self):
+        ill = np.flatnonzero(self.status == ILL)
+        self.events = EventQueue()
+        self.events.push(ill,self.fut_time.ravel()[ill])
+    
+    def step(self,dt,current_time,box_size,ill_spec,recov_spec,death_spec,
+             mask_protect=None,search='cell'):
+        """
+        Update all replicas at this interval, the arguments are the same as sub_stat.
+        The search is ignored, the replicas always use the cell grid of _replica_pairs
+        since comparing all the subjects of all replicas grows as R^2
+        """
+        box_size = np.asarray(box_size)
+        # Whose times up in this step
+        rep,sub = np.divmod(self.events.pop(current_time),self.status.shape[1])
+        self.fut_time[rep,sub] = np.inf
+        # The dead stop moving
+        is_dead = self.fut_stat[rep,sub] == 0
+        self.status[rep[is_dead],sub[is_dead]] = DEAD
+        self.vel[rep[is_dead],:,sub[is_dead]] = 0
+        self.status[rep[~is_dead],sub[~is_dead]] = RECOVERED
+        
+        # The pairs are only searched within each replica
+        r_inf = _mask_radius(ill_spec[0],mask_protect)
+        ill_rep,ill_sub = np.nonzero(self.status == ILL)
+        health_rep,health_sub = np.nonzero(self.status == HEALTH)
+        if ill_rep.size == 0 or health_rep.size == 0:
+            health_idx = np.array([],dtype=np.int64)
+        else:
+            ill_idx,health_idx = _replica_pairs(self.pos,(ill_rep,ill_sub),(health_rep,health_sub),
+                                                box_size,r_inf)
+        get_ill = _infected_contacts(health_idx,health_rep.size,self.vel[health_rep,:,health_sub].T,
+                                     dt,r_inf,ill_spec,self.rng)
+        if get_ill.size == 0:
+            # no subject is infected in this interval, pass
+            pass
+        else:
+            rep,sub = health_rep[get_ill],health_sub[get_ill]
+            self.status[rep,sub] = ILL
+            self.fut_stat[rep,sub],self.fut_time[rep,sub] = fut_status(get_ill.size,current_time,
+                                                                       recov_spec,death_spec,
+                                                                       self.rng)
+            self.events.push(rep*self.status.shape[1]+sub,self.fut_time[rep,sub])
+        
+        # Update positions and velocities of all replicas in a single pass
+        next_pos_v_inplace(self.pos,self.vel,box_size,dt,self._work)
+    
+    def next_event_time(self):
+        """
+        The time stamp of the next recovery or death over all replicas, inf if nobody is ill
+        """
+        return self.events.next_time()
+    
+    def counts(self):
+        """
+        Number of the healthy, ill, recovered and dead subjects, a (4,R) array
+        """
+        return np.stack([np.sum(self.status == code,axis=1) for code in (HEALTH,ILL,RECOVERED,DEAD)])
+    
+    def load_state(self,state):
+        """
+        Restore the state arrays, see Population.load_state
+        """
+        for key in _population_keys:
+            setattr(self,key,np.array(state[key],dtype=getattr(self,key).dtype))
+        self._work = np.empty_like(self.pos)
+        self._new_events()
+    
+    def views(self,replica=0):
+        """
+        The compatibility view of one replica with the tuple API of Subject.run
+        """
+        status = self.status[replica]
+        pos,vel = self.pos[replica],self.vel[replica]
+        ill = status == ILL
+        health = status == HEALTH
+        recov = status == RECOVERED
+        ti = np.array([self.fut_stat[replica,ill],self.fut_time[replica,ill]])
+        return (pos[:,ill],pos[:,health],pos[:,recov],pos[:,status == DEAD],
+                vel[:,ill],vel[:,health],vel[:,recov],ti)
+
+
 ################################################
 #                                              #
 #                Subject class                 #
@@ -386,9 +965,81 @@ def sub_stat(ill,health,recov,death,
 ################################################
 
 
+# Keys of the statistic recorded in every step
+_stat_keys = ['Ill','Health','Recovered','Dead','Time']
+# The tuple engine state saved in the checkpoints
+_tuple_keys = ['xi','xh','xr','xd','vi','vh','vr','ti']
+
+
+class StatisticRecorder:
+    """
+    Statistics of each step kept in a structured array preallocated to capacity, the
+    capacity is doubled whenever it is full, so that recording is amortized O(1)
+    
+    The observers subscribed are called with the record of every new step, which is
+    a view into the buffer, eg. record['Ill'], copy it if it should be kept
+    
+    capacity: initial number of records
+    shape: shape of each count, () for a single run or (R,) for R replicas
+    """
+    
+    def __init__(self,capacity=1024,shape=()):
+        dtype = [(key,float,() if key == 'Time' else shape) for key in _stat_keys]
+        self._data = np.zeros(max(capacity,1),dtype=dtype)
+        self._size = 0
+        self._observers = []
+    
+    def __len__(self):
+        return self._size
+    
+    def append(self,n_ill,n_health,n_recov,n_dead,time):
+        if self._size == len(self._data):
+            data = np.zeros(2*len(self._data),dtype=self._data.dtype)
+            data[:self._size] = self._data
+            self._data = data
+        else: pass
+        record = self._data[self._size:self._size+1]
+        record['Ill'],record['Health'] = n_ill,n_health
+        record['Recovered'],record['Dead'] = n_recov,n_dead
+        record['Time'] = time
+        self._size += 1
+        for callback in self._observers:
+            callback(record[0])
+    
+    def subscribe(self,callback):
+        """
+        Call callback(record) at every new step
+        """
+        self._observers.append(callback)
+    
+    def unsubscribe(self,callback):
+        self._observers.remove(callback)
+    
+    @property
+    def data(self):
+        return self._data[:self._size]
+    
+    def as_dict(self):
+        """
+        Dict of the recorded statistics, each key is a view into the buffer
+        """
+        data = self.data
+        return {key:data[key] for key in _stat_keys}
+    
+    def load(self,data):
+        """
+        Replace the records with data, eg. the statistics saved in a checkpoint
+        """
+        self._data = np.zeros(max(len(data),len(self._data)),dtype=self._data.dtype)
+        self._data[:len(data)] = data
+        self._size = len(data)
+
+
 class Subject:
     
-    def __init__(self,n_ill,n_health,prange,vrange,box_size,inf_spec,recov_spec,dead_spec,dt):
+    def __init__(self,n_ill,n_health,prange,vrange,box_size,inf_spec,recov_spec,dead_spec,dt,
+                 search='brute',engine='tuple',store=None,record_every=1,steps=None,
+                 replicas=None,seed=None):
         self.n_ill = n_ill
         self.n_health = n_health
         self.prange = prange
@@ -397,46 +1048,181 @@ class Subject:
         self.inf_spec = inf_spec
         self.recov_spec = recov_spec
         self.dead_spec = dead_spec
-        # the statistic of the current step
-        self._statistic = {'Ill':[],
-                           'Health':[],
-                           'Recovered':[],
-                           'Dead':[],
-                           'Time':[],
-                           'dt':dt}
+        self.dt = dt
+        # neighbor search backend for the infection
+        self.search = search
+        # 'tuple' moves subjects between the arrays of each status, 'array' keeps all
+        # subjects in the single Population state arrays, 'jit' advances the same arrays
+        # with the numba-compiled kernel
+        if engine not in ('tuple','array','jit'):
+            raise ValueError('The engine should be one of \'tuple\', \'array\' or \'jit\'')
+        else: pass
+        self.engine = engine
+        self.population = None
+        # Full output is recorded every record_every steps, None for statistics only
+        if record_every is None or (type(record_every) == int and record_every > 0):
+            self.record_every = record_every
+        else:
+            raise ValueError('record_every should be a positive integer or None')
+        # Advance R independent replicas at once, statistics only
+        if replicas is None:
+            pass
+        elif engine != 'array' or record_every is not None or store is not None:
+            raise ValueError('replicas needs the \'array\' engine and record_every=None')
+        else: pass
+        self.replicas = replicas
+        # None draws from the global np.random state, otherwise the run owns a
+        # numpy.random.Generator seeded with seed
+        self.rng = get_rng(seed)
+        # the statistic of each step, preallocated for steps+1 records if steps is given,
+        # each count is a (R,) array for the replicas
+        self._statistic = StatisticRecorder(1024 if steps is None else steps+1,
+                                            () if replicas is None else (replicas,))
         # Raw data of all subjects' status including the preceeding steps
         self._fullout = []
+        # Stream the frames to the on-disk store with this path prefix instead of
+        # keeping them in _fullout, the store is opened by get_init or set_state
+        self._store = store
+        self._writer = None
+    
+    def _open_store(self,frames=0):
+        if self._store is None:
+            pass
+        else:
+            codes = {'Health':HEALTH,'Ill':ILL,'Recovered':RECOVERED,'Dead':DEAD}
+            self._writer = TrajectoryWriter(self._store,self.n_ill+self.n_health,codes,
+                                            frames=frames)
+    
+    def _snapshot_due(self):
+        return self.record_every is not None and len(self._statistic) % self.record_every == 0
     
     def _update(self,xi,xh,xr,xd,vi,vh,vr,ti,time):
-        # update statistic
-        self._statistic['Ill'] = np.append(self._statistic['Ill'],len(xi[0]))
-        self._statistic['Health'] = np.append(self._statistic['Health'],len(xh[0]))
-        self._statistic['Recovered'] = np.append(self._statistic['Recovered'],len(xr[0]))
-        self._statistic['Dead'] = np.append(self._statistic['Dead'],len(xd[0]))
-        self._statistic['Time']=np.append(self._statistic['Time'],time)
         # Recorde full output at specific time
-        self._fullout.append({'IllPosition':xi,
-                                 'IllVelocity':vi,
-                                 'HealthPosition':xh,
-                                 'HealthVelocity':vh,
-                                 'RecoveredPosition':xr,
-                                 'RecoveredVelocity':vr,
-                                 'DeadPosition':xd
-                             })
+        if not self._snapshot_due():
+            pass
+        elif self._store is None:
+            self._fullout.append({'IllPosition':xi,
+                                     'IllVelocity':vi,
+                                     'HealthPosition':xh,
+                                     'HealthVelocity':vh,
+                                     'RecoveredPosition':xr,
+                                     'RecoveredVelocity':vr,
+                                     'DeadPosition':xd
+                                 })
+        elif self.population is None:
+            self._writer.write_groups([xi,xh,xr,xd],[ILL,HEALTH,RECOVERED,DEAD],time)
+        else:
+            self._writer.write(self.population.status,self.population.pos,time)
+        # update statistic
+        self._statistic.append(len(xi[0]),len(xh[0]),len(xr[0]),len(xd[0]),time)
+    
+    def _get_init_replicas(self):
+        # Generate all replicas at once and stack them on the leading axis
+        num = self.replicas
+        xi,vi,ti = init_ill(recov_spec=self.recov_spec,dead_spec=self.dead_spec,
+                            prange=self.prange,vrange=self.vrange,num=self.n_ill*num,
+                            rng=self.rng)
+        xh,vh = init_health(prange=self.prange,vrange=self.vrange,num=self.n_health*num,
+                            rng=self.rng)
+        stack = lambda x: x.reshape(2,num,-1).transpose(1,0,2)
+        self.population = ReplicaPopulation(stack(xi),stack(xh),stack(vi),stack(vh),stack(ti),
+                                            self.rng)
+        n_health,n_ill,n_recov,n_dead = self.population.counts()
+        self._statistic.append(n_ill,n_health,n_recov,n_dead,0)
+        return self.population.views(0)
     
     def get_init(self):
+        if self.replicas is not None:
+            return self._get_init_replicas()
+        else: pass
         xi,vi,ti = init_ill(recov_spec=self.recov_spec,dead_spec=self.dead_spec,
-                            prange=self.prange,vrange=self.vrange,num=self.n_ill)
-        xh,vh = init_health(prange=self.prange,vrange=self.vrange,num=self.n_health)
+                            prange=self.prange,vrange=self.vrange,num=self.n_ill,rng=self.rng)
+        xh,vh = init_health(prange=self.prange,vrange=self.vrange,num=self.n_health,rng=self.rng)
         xr = np.array([[],[]])
         vr = np.array([[],[]])
         xd = np.array([[],[]])
+        self._new_population(xi,xh,vi,vh,ti)
+        self._open_store()
         self._update(xi,xh,xr,xd,vi,vh,vr,ti,0)
         return xi,xh,xr,xd,vi,vh,vr,ti
     
+    def _new_population(self,xi,xh,vi,vh,ti):
+        if self.engine == 'array':
+            self.population = Population(xi,xh,vi,vh,ti,self.rng)
+        elif self.engine == 'jit':
+            from core_numba import JitPopulation
+            self.population = JitPopulation(xi,xh,vi,vh,ti,self.rng)
+        else: pass
+    
+    def get_state(self,time,step,views=None):
+        """
+        The dict of arrays to resume the run from, see set_state. The streamed frames
+        are flushed so that the store holds every frame up to this step
+        
+        Input
+        ------
+        time: the current time stamp
+        step: number of steps taken
+        views: the xi,xh,xr,xd,vi,vh,vr,ti tuple of the 'tuple' engine
+        """
+        if self._writer is not None:
+            self._writer.flush()
+        else: pass
+        state = {'engine':np.array(self.engine),'time':np.array(time),'step':np.array(step),
+                 'statistic':self._statistic.data,'rng':np.array(rng_state(self.rng)),
+                 'frames':np.array(0 if self._writer is None else self._writer.frames_written)}
+        if self.population is None:
+            state.update(zip(_tuple_keys,views))
+        else:
+            state.update({key:getattr(self.population,key) for key in _population_keys})
+        return state
+    
+    def set_state(self,state):
+        """
+        Resume the run from the state of get_state, the streamed frames recorded after
+        the state was taken are dropped
+        
+        Output
+        ------
+        tuple: time stamp, number of steps taken and the xi,xh,xr,xd,vi,vh,vr,ti tuple
+        """
+        if str(state['engine']) != self.engine:
+            raise ValueError('The checkpoint is taken with the \''+str(state['engine'])
+                             +'\' engine but the run uses the \''+self.engine+'\' engine')
+        else: pass
+        if self.engine == 'tuple':
+            views = tuple(state[key] for key in _tuple_keys)
+        else:
+            empty = np.zeros((2,0)) if self.replicas is None else np.zeros((self.replicas,2,0))
+            if self.replicas is None:
+                self._new_population(empty,empty,empty,empty,empty)
+            else:
+                self.population = ReplicaPopulation(empty,empty,empty,empty,empty,self.rng)
+        set_rng_state(self.rng,str(state['rng']))
+        if self.population is not None:
+            self.population.load_state(state)
+            views = self.population.views()
+        else: pass
+        self._statistic.load(state['statistic'])
+        self._open_store(int(state['frames']))
+        return float(state['time']),int(state['step']),views
+    
     def run(self,xi,xh,xr,xd,vi,vh,vr,ti,dt,time,mask):
+        if self.replicas is not None:
+            # The tuple is the view of the first replica
+            self.step(dt,time,mask)
+            return self.population.views(0)
+        elif self.engine in ('array','jit'):
+            # The state lives in self.population, the input tuple is ignored
+            self.population.step(dt,time,self.box_size,self.inf_spec,self.recov_spec,
+                                 self.dead_spec,mask,self.search)
+            xi,xh,xr,xd,vi,vh,vr,ti = self.population.views()
+            self._update(xi,xh,xr,xd,vi,vh,vr,ti,time)
+            return xi,xh,xr,xd,vi,vh,vr,ti
+        else: pass
         xi,xh,xr,xd,vi,vh,vr,ti = sub_stat(xi,xh,xr,xd,vi,vh,vr,ti,dt,time,
-                                           self.inf_spec,self.recov_spec,self.dead_spec,mask)
+                                           self.inf_spec,self.recov_spec,self.dead_spec,mask,
+                                           self.search,self.rng)
         # Update positions and velocities
         xi,vi=next_pos_v(xi,vi,box_size=self.box_size,dt=dt)
         xh,vh=next_pos_v(xh,vh,box_size=self.box_size,dt=dt)
@@ -444,9 +1230,76 @@ class Subject:
         self._update(xi,xh,xr,xd,vi,vh,vr,ti,time)
         return xi,xh,xr,xd,vi,vh,vr,ti
     
+    def step(self,dt,time,mask):
+        """
+        Advance the 'array' or 'jit' engine without building the tuple views, the
+        statistics come from the status counts and the views are only built for the
+        in-memory full output
+        """
+        if self.population is None:
+            raise ValueError('Subject.step needs the \'array\' or \'jit\' engine and get_init')
+        else: pass
+        self.population.step(dt,time,self.box_size,self.inf_spec,self.recov_spec,
+                             self.dead_spec,mask,self.search)
+        self._record(time)
+    
+    def advance(self,dt,time,mask,max_steps=1):
+        """
+        Event-driven Subject.step, take up to max_steps steps of dt at once when no
+        contact is possible, see Population.advance. The statistics are recorded for
+        every step and the full output is never skipped. Returns the number of steps
+        """
+        if self.population is None:
+            raise ValueError('Subject.advance needs the \'array\' or \'jit\' engine and get_init')
+        elif self.replicas is not None:
+            # the replicas are advanced in lockstep
+            self.step(dt,time,mask)
+            return 1
+        else: pass
+        # stop at the next recorded frame
+        if self.record_every is not None:
+            max_steps = min(max_steps,-len(self._statistic) % self.record_every+1)
+        else: pass
+        num = self.population.advance(dt,time,self.box_size,self.inf_spec,self.recov_spec,
+                                      self.dead_spec,mask,self.search,max_steps)
+        # nothing changes in the steps after the first one
+        n_health,n_ill,n_recov,n_dead = self.population.counts()
+        for s in range(num-1):
+            self._statistic.append(n_ill,n_health,n_recov,n_dead,time+s*dt)
+        self._record(time+(num-1)*dt)
+        return num
+    
+    def _record(self,time):
+        pop = self.population
+        if self._snapshot_due() and self._store is None:
+            # the in-memory full output is made of the views
+            self._update(*pop.views(),time)
+            return
+        elif self._snapshot_due():
+            self._writer.write(pop.status,pop.pos,time)
+        else: pass
+        n_health,n_ill,n_recov,n_dead = pop.counts()
+        self._statistic.append(n_ill,n_health,n_recov,n_dead,time)
+    
+    def close(self):
+        """
+        Flush and close the trajectory store
+        """
+        if self._writer is not None:
+            self._writer.close()
+        else: pass
+    
+    def subscribe(self,callback):
+        """
+        Call callback(record) with the statistic record of every step, see StatisticRecorder
+        """
+        self._statistic.subscribe(callback)
+    
     @property
     def statistic(self):
-        return self._statistic
+        statistic = self._statistic.as_dict()
+        statistic['dt'] = self.dt
+        return statistic
     
     @property
     def fullout(self):
@@ -0,0 +1,165 @@
+import math
+import numpy as np
+from core import HEALTH,ILL,RECOVERED,DEAD,Population
+from sampler import random_seed
+
+try:
+    from numba import njit
+    numba_flag = True
+except ImportError:
+    numba_flag = False
+
+
+################################################
+#                                              #
+#            Numba-compiled step kernel        #
+#                                              #
+################################################
+
+
+if numba_flag:
+    
+    @njit(cache=True)
+    def _seed(seed):
+        np.random.seed(seed)
+    
+    @njit(cache=True)
+    def _truncnorm(t_avg,t_std):
+        # rejection sampling of the normal variate truncated at 0
+        while True:
+            x = t_avg+t_std*np.random.standard_normal()
+            if x > 0:
+                return x
+    
+    @njit(cache=True)
+    def _norm_cdf(z):
+        return 0.5*math.erfc(-z/math.sqrt(2.))
+    
+    @njit(cache=True)
+    def _step_kernel(pos,vel,status,fut_stat,fut_time,box,dt,current_time,
+                     r_inf,t_inf_avg,t_inf_std,recov_spec,death_spec,cell,head,link,new_ill):
+        # the subjects infected in this step are written to new_ill, their number is returned
+        num = status.size
+        n_new = 0
+        # cell list covering the simulation box
+        nx,ny = head.shape
+        head[:,:] = -1
+        
+        # transitions and the cell list of the ill subjects
+        for i in range(num):
+            if status[i] == ILL:
+                if fut_time[i] < current_time:
+                    fut_time[i] = np.inf
+                    if fut_stat[i] == 0:
+                        status[i] = DEAD
+                        vel[0,i] = 0.
+                        vel[1,i] = 0.
+                    else:
+                        status[i] = RECOVERED
+                else:
+                    cx = min(max(int((pos[0,i]-box[0,0])/cell),0),nx-1)
+                    cy = min(max(int((pos[1,i]-box[1,0])/cell),0),ny-1)
+                    link[i] = head[cx,cy]
+                    head[cx,cy] = i
+        
+        # infection, the probability that t_inf drawn from the truncated normal is
+        # smaller than the time of passing through r_inf
+        cdf_0 = _norm_cdf(-t_inf_avg/t_inf_std)
+        r2 = r_inf*r_inf
+        for i in range(num):
+            if status[i] != HEALTH:
+                continue
+            cx = min(max(int((pos[0,i]-box[0,0])/cell),0),nx-1)
+            cy = min(max(int((pos[1,i]-box[1,0])/cell),0),ny-1)
+            near = False
+            for ix in range(max(cx-1,0),min(cx+2,nx)):
+                for iy in range(max(cy-1,0),min(cy+2,ny)):
+                    j = head[ix,iy]
+                    while j >= 0 and not near:
+                        dx = pos[0,i]-pos[0,j]
+                        dy = pos[1,i]-pos[1,j]
+                        near = dx*dx+dy*dy < r2
+                        j = link[j]
+            if not near:
+                continue
+            speed = math.sqrt(vel[0,i]**2+vel[1,i]**2)
+            t_pass = min(r_inf/speed,dt) if speed > 0 else dt
+            p_inf = (_norm_cdf((t_pass-t_inf_avg)/t_inf_std)-cdf_0)/(1.-cdf_0)
+            if np.random.random() < p_inf:
+                status[i] = ILL
+                new_ill[n_new] = i
+                n_new += 1
+                recov_time = current_time+_truncnorm(recov_spec[0],recov_spec[1])
+                dead_time = current_time+_truncnorm(death_spec[0],death_spec[1])
+                if recov_time < dead_time:
+                    fut_stat[i],fut_time[i] = 1,recov_time
+                else:
+                    fut_stat[i],fut_time[i] = 0,dead_time
+        
+        # movement, the positions are folded back into the box
+        for axis in range(2):
+            b_min = box[axis,0]
+            width = box[axis,1]-b_min
+            for i in range(num):
+                x = pos[axis,i]+vel[axis,i]*dt-b_min
+                bounce = math.floor(x/width)
+                if bounce % 2 != 0:
+                    vel[axis,i] = -vel[axis,i]
+                x = x % (2*width)
+                pos[axis,i] = b_min+min(x,2*width-x)
+        return n_new
+
+
+class JitPopulation(Population):
+    """
+    Population advanced by the numba-compiled kernel fusing the transitions, the
+    cell list contact detection, the infection sampling and the movement in one call.
+    Falls back to the NumPy Population.step if numba is not installed. The kernel
+    reports the new infections, hence the events are kept as in Population
+    """
+    
+    def __init__(self,xi,xh,vi,vh,ti,rng=None):
+        Population.__init__(self,xi,xh,vi,vh,ti,rng)
+        self._head = None
+        self._link = np.empty(self.status.size,dtype=np.int64)
+        self._new_ill = np.empty(self.status.size,dtype=np.int64)
+    
+    def step(self,dt,current_time,box_size,ill_spec,recov_spec,death_spec,
+             mask_protect=None,search='brute'):
+        if not numba_flag:
+            return Population.step(self,dt,current_time,box_size,ill_spec,recov_spec,
+                                   death_spec,mask_protect,search)
+        else: pass
+        
+        r_inf,t_avg,t_std = ill_spec
+        if mask_protect is None:
+            pass
+        elif mask_protect < 1:
+            raise ValueError('The mask protectability should be larger than 1')
+        else:
+            r_inf = r_inf/mask_protect
+        
+        box_size = np.asarray(box_size,dtype=float)
+        # cells no smaller than r_inf, at most 4096 per side
+        width = box_size[:,1]-box_size[:,0]
+        cell = max(r_inf,width.max()/4096)
+        shape = tuple((width//cell).astype(np.int64)+1)
+        if self._head is None or self._head.shape != shape:
+            self._head = np.empty(shape,dtype=np.int64)
+        else: pass
+        
+        # numba has its own random state, it is seeded from the rng every step, hence
+        # the state of the rng in a checkpoint is all the randomness of the run
+        _seed(random_seed(self.rng))
+        n_new = _step_kernel(self.pos,self.vel,self.status,self.fut_stat,self.fut_time,box_size,
+                             float(dt),float(current_time),float(r_inf),float(t_avg),float(t_std),
+                             np.asarray(recov_spec,dtype=float),np.asarray(death_spec,dtype=float),
+                             cell,self._head,self._link,self._new_ill)
+        # the kernel took the transitions due at current_time, the same as the events popped
+        self.events.pop(current_time)
+        self.events.push(self._new_ill[:n_new],self.fut_time[self._new_ill[:n_new]])
+    
+    def load_state(self,state):
+        Population.load_state(self,state)
+        self._link = np.empty(self.status.size,dtype=np.int64)
+        self._new_ill = np.empty(self.status.size,dtype=np.int64)
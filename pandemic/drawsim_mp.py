@@ -1,10 +1,13 @@
-import os,sys
+import os,sys,threading,queue,shutil,tempfile
 import numpy as np
-import matplotlib.pyplot as plt
+from collections import deque
 from multiprocessing import Pool,cpu_count
 #mp.get_start_method('spawn')
 from timeit import default_timer as timer
-from pandsim import loadsim
+from core import HEALTH,ILL,RECOVERED,DEAD
+from pandsim import loadsim,record_stride,frame_range
+from store import TrajectoryReader,TrajectoryWriter
+from render import FrameRenderer,VideoStream,frame_title,rasterize
 import seaborn as sns
 sns.set(color_codes=True)
 
@@ -17,25 +20,86 @@ sns.set(color_codes=True)
 ################################################
 
 
-def _drawfullout(s,out,info,disease_name,box_size,ext_x,ext_y,skip,dpi):
-    out = out
-    info = info
-    fig = plt.figure()
-    plt.scatter(out['HealthPosition'][0],out['HealthPosition'][1],c='limegreen',alpha=0.6)
-    plt.scatter(out['IllPosition'][0],out['IllPosition'][1],c='orangered',alpha=0.6)
-    plt.scatter(out['RecoveredPosition'][0],out['RecoveredPosition'][1],c='steelblue',alpha=0.6)
-    plt.scatter(out['DeadPosition'][0],out['DeadPosition'][1],c='k',alpha=0.6)
-    plt.xlim(box_size[0,0]-ext_x,box_size[0,1]+ext_x)
-    plt.ylim(box_size[1,0]-ext_y,box_size[1,1]+ext_y)
-    plt.title(r'$t=$'+str(int(info//24))+'d'
-                +r', $N_{\rm h}=$'+str(len(out['HealthPosition'][0]))
-                +r', $N_{\rm ill}$='+str(len(out['IllPosition'][0]))
-                +r', $N_{\rm recov}=$'+str(len(out['RecoveredPosition'][0]))
-                +r', $N_{\rm dead}=$'+str(len(out['DeadPosition'][0])))
-    plt.xlabel('$X$ [meters]')
-    plt.ylabel('$Y$ [meters]')
-    plt.savefig(str(disease_name)+'/images/'+str(s//skip+1)+'.png',dpi=dpi,bbox_inches='tight')
-    plt.close(fig)
+# The simulation data and the figure of each worker process, see _init_worker
+_worker = {}
+
+
+def _load_summary(disease_name):
+    """
+    The summary of the run and its number of recorded frames, the frames themselves
+    are not loaded
+    """
+    prefix = str(disease_name)+'/'+str(disease_name)
+    info = np.load(prefix+'_summary.npy',allow_pickle=True).item()
+    # a frame is recorded every RecordEvery statistic records from the first one
+    return info,(len(info['Time'])-1)//record_stride(info)+1
+
+
+def _open_frames(disease_name):
+    """
+    The path prefix of the trajectory store read by the workers and the temporary folder
+    to remove afterwards. The frames of a run without stream are loaded once here and
+    written to a temporary store, otherwise every worker would load all of them
+    """
+    prefix = str(disease_name)+'/'+str(disease_name)
+    info,out = loadsim(disease_name)
+    if info.get('Stream',False) or isinstance(out,TrajectoryReader):
+        return prefix,None
+    else: pass
+    folder = tempfile.mkdtemp(dir=str(disease_name))
+    keys = ['IllPosition','HealthPosition','RecoveredPosition','DeadPosition']
+    record_every = record_stride(info)
+    try:
+        num = sum(len(out[0][key][0]) for key in keys)
+        codes = {'Health':HEALTH,'Ill':ILL,'Recovered':RECOVERED,'Dead':DEAD}
+        with TrajectoryWriter(folder+'/frames',num,codes) as writer:
+            for s,frame in enumerate(out):
+                writer.write_groups([frame[key] for key in keys],[ILL,HEALTH,RECOVERED,DEAD],
+                                    info['Time'][s*record_every])
+    except BaseException:
+        shutil.rmtree(folder,ignore_errors=True)
+        raise
+    return folder+'/frames',folder
+
+
+def _init_worker(disease_name,prefix,dpi,raster=False):
+    """
+    Every worker opens the memory-mapped trajectory store of _open_frames, the frames
+    are read from the disk on demand and shared through the page cache, only the frame
+    indices are sent to the workers
+    """
+    info,n_frames = _load_summary(disease_name)
+    _worker['disease_name'] = disease_name
+    _worker['info'] = info
+    _worker['out'] = TrajectoryReader.open(prefix)
+    _worker['record_every'] = record_stride(info)
+    _worker['renderer'] = None if raster else FrameRenderer(np.asarray(info['BoxSize']),dpi)
+    _worker['image'] = None
+
+
+def _drawframe(s):
+    # the renderer of this worker is updated to the s-th recorded frame
+    info,out = _worker['info'],_worker['out']
+    k = s*_worker['record_every']
+    return _worker['renderer'].draw(out[s],frame_title(info['Time'][k],info['Health'][k],
+                                                       info['Ill'][k],info['Recovered'][k],
+                                                       info['Dead'][k]))
+
+
+def _drawfullout(task):
+    s,label = task
+    _drawframe(s).savefig(str(_worker['disease_name'])+'/images/'+str(label)+'.png')
+    return label
+
+
+def _renderframe(s):
+    # the RGB image of the s-th recorded frame, sent back to the encoder
+    if _worker['renderer'] is None:
+        _worker['image'] = rasterize(_worker['out'][s],_worker['info']['BoxSize'],
+                                     out=_worker['image'])
+        return _worker['image']
+    else:
+        return _drawframe(s).to_array()
 
 
 def drawsim_mp(disease_name,skip=None,dpi=150,cores=None):
@@ -45,7 +109,7 @@ def drawsim_mp(disease_name,skip=None,dpi=150,cores=None):
     Input
     ------
     disease_name: name of the project folder in the same location
-    skip: how many dt should be skip between figures
+    skip: how many recorded frames should be skip between figures
     dpi: resolution
     cores: how many number of cores to be parallized, default is half of the machine cores
            Input number larger than the physics core numbers will not improve the speed
@@ -54,46 +118,39 @@ def drawsim_mp(disease_name,skip=None,dpi=150,cores=None):
     ------
     PNG figures of specified steps and summary plot
     '''
-    # check if images folder exists, if not, create it
-    if os.path.isdir(str(disease_name)+'/images'):
-        pass
-    else:
-        os.mkdir(str(disease_name)+'/images')
-    
     if cores is None:
         cores = int(np.ceil(cpu_count()/2))
     elif cores > 1 and type(cores)==int:
         pass
     else:
         raise ValueError('Number of cpu cores must be positive integer')
-
-    # load data
-    info,out = loadsim(disease_name)
-    # setup
-    box_size = np.asarray(info['BoxSize'])
-    time_stamp = info['Time']
-    steps = len(time_stamp)
-    # extension on the boundary when drawing
-    ext_x = (box_size[0,1]-box_size[0,0])*0.025
-    ext_y = (box_size[1,1]-box_size[1,0])*0.025
     
-    if type(skip) == int and skip > 0:
-        label_range = range(0,steps,skip)
-    elif skip is None:
-        label_range = range(steps)
-        skip = 1
+    # only the number of frames is needed here, the workers read the frames by themselves
+    info,n_frames = _load_summary(disease_name)
+    label_range,skip = frame_range(n_frames,skip)
+    
+    # check if images folder exists, if not, create it
+    if os.path.isdir(str(disease_name)+'/images'):
+        pass
     else:
-        raise ValueError('The input skip is not a positive integer, please check again')
+        os.mkdir(str(disease_name)+'/images')
+    tasks = [(s,s//skip+1) for s in label_range]
     
     print('Parallizing the drawing process, please wait...',end='\r')
-    # Multiprocessing the drawing process
-    start = timer()  
-    with Pool(cores) as pool:
-        for s in label_range:
-            pool.apply_async(_drawfullout,(s,out[s],info['Time'][s],disease_name,box_size,ext_x,ext_y,skip,dpi))
-        pool.close()
-        pool.join()
-    sys.stdout.flush()
+    # Multiprocessing the drawing process, the tasks are handed out in chunks and
+    # an exception raised in a worker is raised here
+    start = timer()
+    prefix,folder = _open_frames(disease_name)
+    try:
+        with Pool(cores,initializer=_init_worker,initargs=(disease_name,prefix,dpi)) as pool:
+            chunksize = max(len(tasks)//(4*cores),1)
+            for done,label in enumerate(pool.imap_unordered(_drawfullout,tasks,chunksize)):
+                print('%d out of %d are plotted'%(done+1,len(tasks)),end='\r')
+                sys.stdout.flush()
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder,ignore_errors=True)
+        else: pass
     end = timer()
     
     # Create and save log file
@@ -104,4 +161,107 @@ def drawsim_mp(disease_name,skip=None,dpi=150,cores=None):
     
     print('Drawing process has completed in '+str(np.round(end-start,2))+' seconds.\nLog file imginfo.txt saved!')
 
+
+def mkvideo_mp(disease_name,fps=15,skip=None,dpi=150,raster=False,backend='cv2',cores=None,
+               window=None):
+    '''
+    Making video with the frames rendered in parallel
     
+    The worker processes render the frames while a single thread encodes them in
+    order, hence rendering and encoding overlap. At most window frames are held at
+    once, being rendered, waiting for the encoder or being encoded, which bounds the memory
+    
+    Input
+    ------
+    disease_name: name of the project folder in the same location
+    fps: frames per second
+    skip: how many recorded frames should be skip between video frames
+    dpi: resolution of the figures
+    raster: render with the NumPy rasterizer, see drawsim
+    backend: 'cv2' or 'ffmpeg', see mkvideo
+    cores: number of render processes, default is half of the machine cores
+    window: number of frames held at once, default is 4 frames per core, at least 3
+            are held, one rendered, one waiting and one encoded
+    
+    Output
+    ------
+    The video <disease_name>/video/<disease_name>.mp4
+    '''
+    if cores is None:
+        cores = int(np.ceil(cpu_count()/2))
+    elif cores > 0 and type(cores)==int:
+        pass
+    else:
+        raise ValueError('Number of cpu cores must be positive integer')
+    if window is None:
+        window = 4*cores
+    elif window > 0 and type(window)==int:
+        pass
+    else:
+        raise ValueError('The window must be positive integer')
+    
+    info,n_frames = _load_summary(disease_name)
+    label_range,skip = frame_range(n_frames,skip)
+    if os.path.isdir(str(disease_name)+'/video'):
+        pass
+    else:
+        os.mkdir(str(disease_name)+'/video')
+    
+    # The encoder thread takes the frames in order from a queue of a single frame, None
+    # stops it. With the frame being encoded and the one waiting in the queue or in the
+    # hand of the producer, window-2 frames are left to be rendered ahead
+    ahead = max(1,window-2)
+    video = VideoStream(str(disease_name)+'/video/'+str(disease_name)+'.mp4',fps,backend)
+    frames = queue.Queue(maxsize=1)
+    error = []
+    def _encode():
+        try:
+            while True:
+                image = frames.get()
+                if image is None:
+                    break
+                else: pass
+                video.write(image)
+        except Exception as e:
+            error.append(e)
+            # keep draining so that the producer is never blocked
+            while frames.get() is not None:
+                pass
+        finally:
+            # the failure of the encoder in closing the file is raised after join as well
+            try:
+                video.close()
+            except Exception as e:
+                error.append(e)
+    encoder = threading.Thread(target=_encode,daemon=True)
+    encoder.start()
+    
+    start = timer()
+    prefix,folder = None,None
+    try:
+        prefix,folder = _open_frames(disease_name)
+        with Pool(cores,initializer=_init_worker,initargs=(disease_name,prefix,dpi,raster)) as pool:
+            # the in-flight frames are kept in submission order, the oldest is
+            # waited for first, an exception in a worker is raised here
+            pending = deque()
+            for s in label_range:
+                if len(pending) == ahead:
+                    frames.put(pending.popleft().get())
+                else: pass
+                pending.append(pool.apply_async(_renderframe,(s,)))
+                if error:
+                    break
+                else: pass
+            while pending and not error:
+                frames.put(pending.popleft().get())
+    finally:
+        frames.put(None)
+        encoder.join()
+        if folder is not None:
+            shutil.rmtree(folder,ignore_errors=True)
+        else: pass
+    if error:
+        raise error[0]
+    else: pass
+    end = timer()
+    print('Video with %d frames completed in %.3f seconds.'%(video.frames_written,end-start))
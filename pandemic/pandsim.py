@@ -1,10 +1,9 @@
-import sys,cv2,os
+import sys,os,warnings
 import numpy as np
-import matplotlib.pyplot as plt
 from timeit import default_timer as timer
-import seaborn as sns
-sns.set(color_codes=True)
 from core import Subject
+from store import TrajectoryReader,has_store
+from checkpoint import Checkpointer,load_checkpoint
 
 
 ################################################
@@ -20,7 +19,9 @@ def PandemicSimulation(n_ill,n_health,
                        prange=[[-250,250],[-250,250]],vrange=[5,30],
                        box_size=[[-600,600],[-600,600]],dt=0.5,steps=24*30*2,
                        save_data=False,disease_name='ukn_disease',
-                       self_adaptive=False,dpi=150):
+                       self_adaptive=False,dpi=150,search='brute',
+                       engine='tuple',stream=False,record_every=1,observer=None,seed=None,
+                       event_driven=False,checkpoint_every=None,resume_from=None):
     """
     This function runs the simulation of pandemic spreading with the given specs
     
@@ -39,11 +40,37 @@ def PandemicSimulation(n_ill,n_health,
     steps: total steps to be run
     disease_name: naming the name of the disease in this simulation
     save_data: save the simulated data, the name will be given by disease_name
+    search: neighbor search backend for the infection
+            'brute': compare each ill subject with all the healthy subjects
+            'cell': uniform grid cell list, suited for large populations
+            'kdtree': ball query with scipy cKDTree
+    engine: 'tuple' moves the subjects between the arrays of each status every step,
+            'array' keeps all subjects in preallocated state arrays, see core.Population
+            'jit' advances the state arrays with the numba kernel, falls back to 'array'
+            if numba is not installed
+    stream: with save_data, stream the frames to the on-disk trajectory store during the
+            run instead of keeping them in memory and saving _fullout.npy in the end
+    record_every: with save_data, record the full output every record_every steps, None for
+                  the statistics only. The statistics are always recorded every step
+    observer: callable, called with the statistic record of every step, eg. record['Ill'],
+              for live monitoring. The record is a view, copy it if it should be kept
+    seed: seed of the numpy.random.Generator owned by this run for reproducible results,
+          default is None for the global np.random state
+    event_driven: with the 'array' or 'jit' engine, take the steps in which no healthy
+                  subject can reach an ill one and nobody recovers or dies as a single
+                  macro step, the statistics are still recorded every step. A macro step
+                  stops at the next recorded frame, hence with save_data it needs
+                  record_every > 1 or None, the default record_every=1 takes single steps
+    checkpoint_every: write the state of the run to disease_name/disease_name_checkpoint.npz
+                      every checkpoint_every steps on a background thread
+    resume_from: path of a checkpoint to continue the run from, the other arguments
+                 should be the same as the run that wrote it
     
     Output
     ------
     dict: dictionary that stores the statistics 
     """
+    _check_event_driven(event_driven,engine,record_every if save_data else None)
     # Create project folder
     if os.path.isdir(str(disease_name)):
         pass
@@ -58,25 +85,49 @@ def PandemicSimulation(n_ill,n_health,
     
     # check if initial position exceeds the box_size
     prange = _checkbox(prange,box_size)
-    sub = Subject(n_ill,n_health,prange,vrange,box_size,inf_spec,recov_spec,dead_spec,dt)
-    # Get the initial condition and setting time stamp
-    xi,xh,xr,xd,vi,vh,vr,ti = sub.get_init()
-    time = 0
+    if save_data and stream:
+        store = str(disease_name)+'/'+str(disease_name)
+    else:
+        store = None
+    # Full output is only needed when it is saved
+    if not save_data:
+        record_every = None
+    else: pass
+    # The frames recorded in memory are not part of the checkpoints
+    if (checkpoint_every is not None or resume_from is not None) and store is None \
+       and record_every is not None:
+        raise ValueError('Checkpoints with save_data need stream=True to keep the recorded frames')
+    else: pass
+    if checkpoint_every is None:
+        checkpoint = None
+    else:
+        checkpoint = Checkpointer(str(disease_name)+'/'+str(disease_name)+'_checkpoint.npz',
+                                  checkpoint_every)
+    resume = None if resume_from is None else load_checkpoint(resume_from)
+    if resume is not None and store is not None and int(resume['frames']) > 0 \
+       and not has_store(store):
+        raise ValueError('The checkpoint '+str(resume_from)+' has %d frames but the trajectory '
+                         %int(resume['frames'])+'store '+store+' is missing, disease_name '
+                         'should be the one of the run that wrote the checkpoint')
+    else: pass
+    sub = Subject(n_ill,n_health,prange,vrange,box_size,inf_spec,recov_spec,dead_spec,dt,search,engine,
+                  store,record_every,steps,seed=seed)
+    if observer is not None:
+        sub.subscribe(observer)
+    else: pass
     
     # Run the simulation until the maximum step is reached
     start_time = timer()
-    for s in range(steps):
-        time += dt
-        xi,xh,xr,xd,vi,vh,vr,ti = sub.run(xi,xh,xr,xd,vi,vh,vr,ti,dt,time,mask_protect)
-        #print(str(s)+' out of '+str(steps)+' steps are completed',end='\r')
-        print('Progress: '+'%.1f%% completed'%(100*s/steps),end='\r')
-        sys.stdout.flush()
+    _run_steps(sub,dt,steps,mask_protect,event_driven=event_driven,checkpoint=checkpoint,
+               resume=resume)
     end_time = timer()
     print('Simulation with total %d steps completed in %.3f seconds'%(steps,end_time - start_time))
     
     def _save(disease_name,sim_out):
         # check if folder exists, if not, create one
-        np.save(str(disease_name)+'/'+str(disease_name)+'_fullout.npy', sim_out.fullout)
+        if store is None:
+            np.save(str(disease_name)+'/'+str(disease_name)+'_fullout.npy', sim_out.fullout)
+        else: pass
         # Append the following to the summary dict
         summary = sim_out.statistic
         summary['BoxSize'] = np.asarray(box_size)
@@ -84,6 +135,9 @@ def PandemicSimulation(n_ill,n_health,
         summary['RecovereddSpec'] = np.asarray(recov_spec)
         summary['DeadSpec'] = np.asarray(dead_spec)
         summary['Mask'] = mask_protect
+        summary['RecordEvery'] = record_every
+        # where the frames are, an earlier run of the other mode may have left its files
+        summary['Stream'] = store is not None
         np.save(str(disease_name)+'/'+str(disease_name)+'_summary.npy', summary)
     
     if save_data:
@@ -92,6 +146,7 @@ def PandemicSimulation(n_ill,n_health,
     else: pass    
     
     # Plot statistics
+    plt = _pyplot()
     plt.plot(sub.statistic['Time']/24,sub.statistic['Health'],label='health',c='limegreen')
     plt.fill_between(sub.statistic['Time']/24, sub.statistic['Health'],color='limegreen',alpha=0.4)
     plt.plot(sub.statistic['Time']/24,sub.statistic['Ill'],label='ill',c='orangered')
@@ -109,6 +164,45 @@ def PandemicSimulation(n_ill,n_health,
     return sub.statistic
 
 
+def simulate(n_ill,n_health,
+             inf_spec=[1,0.25,0.5],recov_spec=[35*24,10*24],
+             dead_spec=[40*24,10*24],mask_protect=None,
+             prange=[[-250,250],[-250,250]],vrange=[5,30],
+             box_size=[[-600,600],[-600,600]],dt=0.5,steps=24*30*2,
+             self_adaptive=False,search='brute',engine='tuple',seed=None,
+             event_driven=False,replicas=None,progress=None,interval=1.):
+    """
+    Headless run of PandemicSimulation for parameter scans, only the statistics are
+    recorded, nothing is written to the disk, plotted or printed
+    
+    Input
+    ------
+    The same as PandemicSimulation for the specs, dt, steps, self_adaptive, search,
+    engine, seed and event_driven, and
+    replicas: run R independent replicas at once with the 'array' engine, each count
+              of the statistics is then a (steps+1,R) array, see core.ReplicaPopulation.
+              The contacts are found on the cell grid of each replica, search is ignored
+    progress: callable, called as progress(step,steps) at most every interval seconds
+              and at the end
+    interval: seconds between the progress calls
+    
+    Output
+    ------
+    dict: the statistics 'Ill', 'Health', 'Recovered', 'Dead', 'Time' and 'dt'
+    """
+    _check_event_driven(event_driven,engine,None)
+    if self_adaptive:
+        dt,steps = _self_adaptive_dt(dt,steps,vrange,inf_spec[0],mask_protect,verbose=False)
+    else: pass
+    prange = _checkbox(prange,box_size)
+    sub = Subject(n_ill,n_health,prange,vrange,np.asarray(box_size),inf_spec,recov_spec,
+                  dead_spec,dt,search,engine,record_every=None,steps=steps,replicas=replicas,
+                  seed=seed)
+    _run_steps(sub,dt,steps,mask_protect,verbose=False,event_driven=event_driven,
+               progress=progress,interval=interval)
+    return sub.statistic
+
+
 ################################################
 #                                              #
 #                Standard I/O                  #
@@ -119,106 +213,192 @@ def PandemicSimulation(n_ill,n_health,
 def loadsim(disease_name):
     '''
     Load the simulation data
+    
+    If the run was streamed to the trajectory store (stream=True), fullout is a lazy
+    store.TrajectoryReader backed by np.memmap, fullout[s] only reads the s-th frame
+    from the disk and supports the same position keys, eg. fullout[s]['IllPosition'].
+    The store keeps the status and the positions only, the velocity keys of _fullout,
+    eg. 'IllVelocity', are not available for the streamed runs
     '''
-    summary = np.load(str(disease_name)+'/'+str(disease_name)+'_summary.npy',allow_pickle=True).item()
-    fullout = np.load(str(disease_name)+'/'+str(disease_name)+'_fullout.npy',allow_pickle=True)
+    prefix = str(disease_name)+'/'+str(disease_name)
+    summary = np.load(prefix+'_summary.npy',allow_pickle=True).item()
+    # the summaries saved before 'Stream' was recorded fall back to the files found
+    if summary.get('Stream',has_store(prefix)):
+        fullout = TrajectoryReader.open(prefix)
+    else:
+        fullout = np.load(prefix+'_fullout.npy',allow_pickle=True)
     return summary,fullout
 
 
-def drawsim(disease_name,skip=None,dpi=150):
+def record_stride(summary):
+    '''
+    Number of the statistic records between the recorded frames of a saved run, the
+    frame s is at the time summary['Time'][s*record_stride(summary)]. The summaries
+    saved before RecordEvery was recorded have a frame every step
+    '''
+    record_every = summary.get('RecordEvery',1)
+    if record_every is None:
+        raise ValueError('The run was saved with record_every=None, it has the statistics '
+                         'only and no frames to draw')
+    else: pass
+    return record_every
+
+
+def frame_range(steps,skip):
+    '''
+    The recorded frames to be drawn given skip, shared by drawsim, mkvideo and
+    their multiprocessing versions in drawsim_mp
+    
+    Input
+    ------
+    steps: number of the recorded frames
+    skip: draw every skip-th frame, a positive integer, or None for every frame
+    
+    Output
+    ------
+    range: the indices of the frames to be drawn
+    skip: skip with None replaced by 1
+    '''
+    if type(skip) == int and skip > 0:
+        return range(0,steps,skip),skip
+    elif skip is None:
+        return range(steps),1
+    else:
+        raise ValueError('The input skip is not a positive integer, please check again')
+
+
+def drawsim(disease_name,skip=None,dpi=150,raster=False):
     '''
     Drawing figures
     
     Input
     ------
     disease_name: name of the project folder in the same location
-    skip: how many dt should be skip between figures
+    skip: how many recorded frames should be skip between figures, a frame is recorded
+          every record_every dt in PandemicSimulation
+    dpi: resolution
+    raster: draw the subjects with the NumPy rasterizer render.rasterize into plain
+            images without axes and title, much faster for large populations
     
     Output
     ------
     PNG figures of specified steps and summary plot
     '''
-    # check if images folder exists, if not, create it
-    if os.path.isdir(str(disease_name)+'/images'):
-        pass
-    else:
-        os.mkdir(str(disease_name)+'/images')
-    
     # load data
     info,out = loadsim(disease_name)
     # setup
     box_size = np.asarray(info['BoxSize'])
-    time_stamp = info['Time']
-    steps = len(time_stamp)
-    # extension on the boundary when drawing
-    ext_x = (box_size[0,1]-box_size[0,0])*0.025
-    ext_y = (box_size[1,1]-box_size[1,0])*0.025
+    # statistics are recorded every step and the frames every record_every steps
+    record_every = record_stride(info)
+    steps = len(out)
     
-    if type(skip) == int and skip > 0:
-        label_range = range(0,steps,skip)
-        steps_label = np.ceil(steps/skip)
-    elif skip is None:
-        label_range = range(steps)
-        steps_label = steps
-        skip = 1
+    # check if images folder exists, if not, create it
+    if os.path.isdir(str(disease_name)+'/images'):
+        pass
     else:
-        raise ValueError('The input skip is not a positive integer, please check again')
+        os.mkdir(str(disease_name)+'/images')
+    
+    label_range,skip = frame_range(steps,skip)
+    steps_label = len(label_range)
     
     start = timer()
 
-    # drawing each step
+    # drawing each step, the figure is created once and only the subjects are updated
+    plt = _pyplot()
+    from render import FrameRenderer,frame_title,rasterize
+    renderer = None if raster else FrameRenderer(box_size,dpi)
+    image = None
     img_array =[]
     for s in label_range:
-        fig = plt.figure()
-        plt.scatter(out[s]['HealthPosition'][0],out[s]['HealthPosition'][1],c='limegreen',alpha=0.6)
-        plt.scatter(out[s]['IllPosition'][0],out[s]['IllPosition'][1],c='orangered',alpha=0.6)
-        plt.scatter(out[s]['RecoveredPosition'][0],out[s]['RecoveredPosition'][1],c='steelblue',alpha=0.6)
-        plt.scatter(out[s]['DeadPosition'][0],out[s]['DeadPosition'][1],c='k',alpha=0.6)
-        plt.xlim(box_size[0,0]-ext_x,box_size[0,1]+ext_x)
-        plt.ylim(box_size[1,0]-ext_y,box_size[1,1]+ext_y)
-        plt.title(r'$t=$'+str(int(info['Time'][s]//24))+'d'
-                  +r', $N_{\rm h}=$'+str(int(info['Health'][s]))
-                  +r', $N_{\rm ill}$='+str(int(info['Ill'][s]))
-                  +r', $N_{\rm recov}=$'+str(int(info['Recovered'][s]))
-                  +r', $N_{\rm dead}=$'+str(int(info['Dead'][s])))
-        plt.xlabel('$X$ [meters]')
-        plt.ylabel('$Y$ [meters]')
-        plt.savefig(str(disease_name)+'/images/'+str(s//skip+1)+'.png',dpi=dpi,bbox_inches='tight')
-        plt.close(fig)
+        k = s*record_every
+        filename = str(disease_name)+'/images/'+str(s//skip+1)+'.png'
+        if raster:
+            image = rasterize(out[s],box_size,out=image)
+            plt.imsave(filename,image)
+        else:
+            renderer.draw(out[s],frame_title(info['Time'][k],info['Health'][k],info['Ill'][k],
+                                             info['Recovered'][k],info['Dead'][k]))
+            renderer.savefig(filename)
         img_array.append(str(s//skip+1)+'.png')
         print(str(s//skip+1)+' out of '+str(int(steps_label))+' are plotted',end='\r')
         sys.stdout.flush()
+    if renderer is not None:
+        renderer.close()
+    else: pass
     end = timer()
     # Save img info for later video making
     np.savetxt(str(disease_name)+'/images/imginfo.txt',np.asarray(img_array),fmt='%s')
     print('Drawing process has completed in '+str(np.round(end-start,2))+' seconds.\nLog file imginfo.txt saved!')
 
     
-def mkvideo(disease_name,fps=15):
+def mkvideo(disease_name,fps=15,skip=None,dpi=150,raster=False,backend='cv2',from_images=False):
     """
     Making video from simulation data
-    """
-    # load image info
-    img_ls = list(np.loadtxt(str(disease_name)+'/images/imginfo.txt',dtype=str))
-    for img in range(len(img_ls)):
-        img_ls[img] = str(disease_name)+'/images/'+img_ls[img]
     
+    Each frame is rendered into a reused buffer and streamed straight into the video
+    encoder, no image file is written and no frame is kept in memory
+    
+    Input
+    ------
+    disease_name: name of the project folder in the same location
+    fps: frames per second
+    skip: how many recorded frames should be skip between video frames
+    dpi: resolution of the figures
+    raster: render with the NumPy rasterizer, see drawsim
+    backend: 'cv2' for cv2.VideoWriter or 'ffmpeg' to pipe the frames into ffmpeg
+    from_images: make the video from the figures of drawsim listed in imginfo.txt
+                 instead, they are read one at a time
+    
+    Output
+    ------
+    The video <disease_name>/video/<disease_name>.mp4
+    """
+    if not from_images:
+        info,out = loadsim(disease_name)
+        record_every = record_stride(info)
+    else: pass
     # check if video folder exists, if not, create it
     if os.path.isdir(str(disease_name)+'/video'):
         pass
     else:
         os.mkdir(str(disease_name)+'/video')
     
-    img_array = []
-    for filename in img_ls:
-        img = cv2.imread(filename)
-        height, width, layers = img.shape
-        size = (width,height)
-        img_array.append(img)
-    out = cv2.VideoWriter(str(disease_name)+'/video/'+str(disease_name)+'.mp4',cv2.VideoWriter_fourcc(*'DIVX'), fps, size)
-    for i in range(len(img_array)):
-        out.write(img_array[i])
-    out.release()
+    _pyplot()
+    from render import FrameRenderer,VideoStream,frame_title,rasterize
+    video = VideoStream(str(disease_name)+'/video/'+str(disease_name)+'.mp4',fps,backend)
+    start = timer()
+    with video:
+        if from_images:
+            import cv2
+            
+            # load image info
+            img_ls = list(np.loadtxt(str(disease_name)+'/images/imginfo.txt',dtype=str,ndmin=1))
+            for filename in img_ls:
+                img = cv2.imread(str(disease_name)+'/images/'+filename)
+                video.write(img[:,:,::-1])
+        else:
+            box_size = np.asarray(info['BoxSize'])
+            label_range,skip = frame_range(len(out),skip)
+            renderer = None if raster else FrameRenderer(box_size,dpi)
+            image = None
+            try:
+                for s in label_range:
+                    k = s*record_every
+                    if raster:
+                        image = rasterize(out[s],box_size,out=image)
+                    else:
+                        image = renderer.draw(out[s],frame_title(info['Time'][k],info['Health'][k],
+                                                                 info['Ill'][k],info['Recovered'][k],
+                                                                 info['Dead'][k])).to_array()
+                    video.write(image)
+                    print(str(video.frames_written)+' out of '+str(len(label_range))+' frames are encoded',end='\r')
+                    sys.stdout.flush()
+            finally:
+                if renderer is not None:
+                    renderer.close()
+                else: pass
+    end = timer()
+    print('Video with %d frames completed in %.3f seconds.'%(video.frames_written,end-start))
 
 
 ################################################
@@ -228,6 +408,78 @@ def mkvideo(disease_name,fps=15):
 ################################################
 
 
+def _run_steps(sub,dt,steps,mask_protect,verbose=True,event_driven=False,checkpoint=None,
+               resume=None,progress=None,interval=0.5):
+    """
+    Get the initial condition of the Subject sub and run it for the given steps,
+    with event_driven the quiet steps are taken at once, see Subject.advance.
+    The state is submitted to the Checkpointer checkpoint when it is due and the
+    run continues from the state resume if given. The progress is printed with
+    verbose and passed to progress(step,steps), at most every interval seconds
+    """
+    last = timer()
+    # Get the initial condition and setting time stamp
+    if resume is None:
+        xi,xh,xr,xd,vi,vh,vr,ti = sub.get_init()
+        time = 0
+        s = 0
+    else:
+        time,s,(xi,xh,xr,xd,vi,vh,vr,ti) = sub.set_state(resume)
+    try:
+        while s < steps:
+            time += dt
+            if event_driven:
+                num = sub.advance(dt,time,mask_protect,steps-s)
+                time += (num-1)*dt
+                s += num
+            elif sub.engine == 'tuple':
+                xi,xh,xr,xd,vi,vh,vr,ti = sub.run(xi,xh,xr,xd,vi,vh,vr,ti,dt,time,mask_protect)
+                s += 1
+            else:
+                sub.step(dt,time,mask_protect)
+                s += 1
+            if checkpoint is not None and checkpoint.due(s):
+                views = (xi,xh,xr,xd,vi,vh,vr,ti) if sub.engine == 'tuple' else None
+                checkpoint.submit(sub.get_state(time,s,views))
+            else: pass
+            if (verbose or progress is not None) and (timer()-last >= interval or s >= steps):
+                last = timer()
+                if verbose:
+                    #print(str(s)+' out of '+str(steps)+' steps are completed',end='\r')
+                    print('Progress: '+'%.1f%% completed'%(100*s/steps),end='\r')
+                    sys.stdout.flush()
+                else: pass
+                if progress is not None:
+                    progress(s,steps)
+                else: pass
+            else: pass
+    finally:
+        # keep the streamed frames readable even if the run is interrupted
+        sub.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        else: pass
+
+
+# Is the seaborn style set, see _pyplot
+_styled = False
+
+
+def _pyplot():
+    """
+    Import matplotlib and set the seaborn style when something is first drawn, hence
+    the simulation itself, eg. in the worker processes, does not pay for the imports
+    """
+    global _styled
+    import matplotlib.pyplot as plt
+    if not _styled:
+        import seaborn as sns
+        sns.set(color_codes=True)
+        _styled = True
+    else: pass
+    return plt
+
+
 def _checkbox(prange,box_size):
     """
     Check if the prange lies outside the box_size.
@@ -246,7 +498,22 @@ def _checkbox(prange,box_size):
     return prange
 
 
-def _self_adaptive_dt(dt,steps,vrange,r_inf,mask_protect):
+def _check_event_driven(event_driven,engine,record_every):
+    """
+    Check event_driven against the engine before anything is created, and warn if
+    the recorded frames leave no room for macro steps
+    """
+    if not event_driven:
+        pass
+    elif engine not in ('array','jit'):
+        raise ValueError('event_driven needs the \'array\' or \'jit\' engine')
+    elif record_every is not None and record_every <= 1:
+        warnings.warn('Every step is recorded with record_every=1, event_driven takes single '
+                      'steps, use a larger record_every or None for macro steps',stacklevel=3)
+    else: pass
+
+
+def _self_adaptive_dt(dt,steps,vrange,r_inf,mask_protect,verbose=True):
     """
     Self adjust the dt to fit the resolution of such simulation system
     """
@@ -262,10 +529,14 @@ def _self_adaptive_dt(dt,steps,vrange,r_inf,mask_protect):
         # unable to resolve, re-calculate dt and total steps
         new_dt = 0.5*r_inf/v_avg
         new_steps = int(tot_time/new_dt)+1
-        print('Self-adaptive dt is on, the new dt and steps are '+str(np.round(new_dt,3))+' and ' +str(new_steps)+'.')
+        if verbose:
+            print('Self-adaptive dt is on, the new dt and steps are '+str(np.round(new_dt,3))+' and ' +str(new_steps)+'.')
+        else: pass
     else:
         # able to resolve, do nothing
         new_dt = dt
         new_steps = steps
-        print('Self-adaptive dt is on, the original dt is able to resolve the simulation system.')
+        if verbose:
+            print('Self-adaptive dt is on, the original dt is able to resolve the simulation system.')
+        else: pass
     return new_dt,new_steps
\ No newline at end of file
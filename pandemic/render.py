@@ -0,0 +1,237 @@
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+
+
+################################################
+#                                              #
+#                Frame renderers               #
+#                                              #
+################################################
+
+
+# Drawing order and colors of each status, the later ones are drawn on top
+_groups = ['Health','Ill','Recovered','Dead']
+_colors = {'Health':'limegreen','Ill':'orangered','Recovered':'steelblue','Dead':'k'}
+
+
+def frame_title(time,n_health,n_ill,n_recov,n_dead):
+    """
+    Title of a frame, the day and the number of subjects of each status
+    """
+    return (r'$t=$'+str(int(time//24))+'d'
+            +r', $N_{\rm h}=$'+str(int(n_health))
+            +r', $N_{\rm ill}$='+str(int(n_ill))
+            +r', $N_{\rm recov}=$'+str(int(n_recov))
+            +r', $N_{\rm dead}=$'+str(int(n_dead)))
+
+
+class FrameRenderer:
+    """
+    The figure of drawsim created once, each frame only replaces the offsets of the
+    scatter collections and the title, hence no figure, axes or artist is rebuilt
+    
+    Input
+    ------
+    box_size: the simulation box, the axes cover it with a 2.5% margin
+    dpi: resolution
+    """
+    
+    def __init__(self,box_size,dpi=150):
+        box_size = np.asarray(box_size)
+        ext_x = (box_size[0,1]-box_size[0,0])*0.025
+        ext_y = (box_size[1,1]-box_size[1,0])*0.025
+        self.dpi = dpi
+        self.fig = plt.figure(dpi=dpi)
+        self.ax = self.fig.add_subplot(111)
+        self.collections = {name:self.ax.scatter([],[],c=_colors[name],alpha=0.6)
+                            for name in _groups}
+        self.ax.set_xlim(box_size[0,0]-ext_x,box_size[0,1]+ext_x)
+        self.ax.set_ylim(box_size[1,0]-ext_y,box_size[1,1]+ext_y)
+        self.ax.set_xlabel('$X$ [meters]')
+        self.ax.set_ylabel('$Y$ [meters]')
+        self.title = self.ax.set_title(frame_title(0,0,0,0,0))
+        # the layout is fixed once instead of bbox_inches='tight' on every frame
+        self.fig.tight_layout()
+        self._background = None
+    
+    def draw(self,frame,title=None):
+        """
+        Update the figure to the frame, a dict of the _fullout or a store.Frame with
+        the keys 'HealthPosition', 'IllPosition', 'RecoveredPosition' and 'DeadPosition'
+        """
+        for name in _groups:
+            self.collections[name].set_offsets(np.asarray(frame[name+'Position']).T)
+        if title is None:
+            pass
+        else:
+            self.title.set_text(title)
+        return self
+    
+    def savefig(self,filename):
+        """
+        Save the current frame as an image, eg. PNG, from the blitted canvas
+        """
+        plt.imsave(filename,self.to_array())
+    
+    def to_array(self):
+        """
+        The (height,width,3) uint8 RGB image of the current frame. The static parts
+        are rendered once and restored for every frame, only the collections and
+        the title are redrawn. The array is a view of the canvas, copy it if it
+        should be kept after the next frame
+        """
+        canvas = self.fig.canvas
+        if self._background is None:
+            # render the figure without the changing artists and keep it
+            artists = list(self.collections.values())+[self.title]
+            for artist in artists:
+                artist.set_visible(False)
+            canvas.draw()
+            self._background = canvas.copy_from_bbox(self.fig.bbox)
+            for artist in artists:
+                artist.set_visible(True)
+        else: pass
+        canvas.restore_region(self._background)
+        for name in _groups:
+            self.ax.draw_artist(self.collections[name])
+        self.fig.draw_artist(self.title)
+        return np.asarray(canvas.buffer_rgba())[:,:,:3]
+    
+    def close(self):
+        plt.close(self.fig)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+
+
+def rasterize(frame,box_size,shape=(720,720),radius=1,out=None):
+    """
+    Pure NumPy rasterizer, the subjects are written as (2*radius-1)^2 pixel squares
+    of their status color straight into a uint8 RGB frame buffer on a white background
+    
+    Input
+    ------
+    frame: a dict of the _fullout or a store.Frame, see FrameRenderer.draw
+    box_size: the simulation box mapped onto the image
+    shape: (height,width) of the image in pixels
+    radius: size of the subjects in pixels
+    out: optional (height,width,3) uint8 buffer reused between frames
+    
+    Output
+    ------
+    array: the (height,width,3) uint8 RGB image, y points upward as in the figures
+    """
+    box_size = np.asarray(box_size,dtype=float)
+    height,width = shape
+    if out is None:
+        out = np.empty((height,width,3),dtype=np.uint8)
+    else: pass
+    out[:] = 255
+    
+    scale = np.array([width/(box_size[0,1]-box_size[0,0]),
+                      height/(box_size[1,1]-box_size[1,0])])
+    for name in _groups:
+        pos = np.asarray(frame[name+'Position'])
+        if pos.size == 0:
+            continue
+        else: pass
+        color = np.round(255*np.array(matplotlib.colors.to_rgb(_colors[name]))).astype(np.uint8)
+        px = ((pos[0]-box_size[0,0])*scale[0]).astype(np.int64)
+        # the image rows run from the top
+        py = height-1-((pos[1]-box_size[1,0])*scale[1]).astype(np.int64)
+        for dx in range(1-radius,radius):
+            for dy in range(1-radius,radius):
+                out[np.clip(py+dy,0,height-1),np.clip(px+dx,0,width-1)] = color
+    return out
+
+
+################################################
+#                                              #
+#               Video streaming                #
+#                                              #
+################################################
+
+
+class VideoStream:
+    """
+    Frames written straight into the video encoder one at a time, no image file is
+    written and no frame is kept after it is encoded, hence the memory is constant
+    
+    Input
+    ------
+    filename: the video file
+    fps: frames per second
+    backend: 'cv2' for cv2.VideoWriter or 'ffmpeg' for an ffmpeg subprocess fed by
+             its stdin, the latter needs the ffmpeg executable
+    """
+    
+    def __init__(self,filename,fps=15,backend='cv2'):
+        if backend not in ('cv2','ffmpeg'):
+            raise ValueError('The backend should be \'cv2\' or \'ffmpeg\'')
+        else: pass
+        self.filename = filename
+        self.fps = fps
+        self.backend = backend
+        self.size = None
+        self._writer = None
+        self._bgr = None
+        self.frames_written = 0
+    
+    def _open(self,height,width):
+        self.size = (width,height)
+        if self.backend == 'cv2':
+            import cv2
+            
+            self._writer = cv2.VideoWriter(self.filename,cv2.VideoWriter_fourcc(*'DIVX'),
+                                           self.fps,self.size)
+            self._bgr = np.empty((height,width,3),dtype=np.uint8)
+        else:
+            import subprocess
+            
+            # yuv420p needs even dimensions, pad the odd ones
+            self._writer = subprocess.Popen(['ffmpeg','-y','-loglevel','error',
+                                             '-f','rawvideo','-pix_fmt','rgb24',
+                                             '-s','%dx%d'%self.size,'-r',str(self.fps),
+                                             '-i','-','-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                                             '-vcodec','libx264','-pix_fmt','yuv420p',
+                                             self.filename],stdin=subprocess.PIPE)
+    
+    def write(self,image):
+        """
+        Encode the (height,width,3) uint8 RGB image, all images should have the same size
+        """
+        if self._writer is None:
+            self._open(*image.shape[:2])
+        elif image.shape[1::-1] != self.size:
+            raise ValueError('The frame is '+str(image.shape[1::-1])+' but the video is '
+                             +str(self.size))
+        else: pass
+        if self.backend == 'cv2':
+            # the reused buffer in the BGR order of OpenCV
+            self._bgr[:] = image[:,:,::-1]
+            self._writer.write(self._bgr)
+        else:
+            self._writer.stdin.write(np.ascontiguousarray(image).data)
+        self.frames_written += 1
+    
+    def close(self):
+        if self._writer is None:
+            return
+        elif self.backend == 'cv2':
+            self._writer.release()
+        else:
+            self._writer.stdin.close()
+            if self._writer.wait() != 0:
+                raise RuntimeError('ffmpeg failed to encode '+self.filename)
+            else: pass
+        self._writer = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
@@ -0,0 +1,74 @@
+import numpy as np
+from scipy.special import ndtr,ndtri
+
+
+################################################
+#                                              #
+#          Truncated normal sampling           #
+#                                              #
+################################################
+
+
+def get_rng(rng=None):
+    """
+    The random source of the samplers, None is the global np.random state for the
+    legacy behavior, an int or SeedSequence seeds a new numpy.random.Generator and a
+    Generator is used as it is
+    """
+    if rng is None or rng is np.random:
+        return np.random
+    elif isinstance(rng,np.random.Generator):
+        return rng
+    else:
+        return np.random.default_rng(rng)
+
+
+def random_seed(rng=None):
+    """
+    A 31-bit seed drawn from rng, eg. to seed the random state of a compiled kernel
+    """
+    rng = get_rng(rng)
+    if rng is np.random:
+        return np.random.randint(2**31)
+    else:
+        return int(rng.integers(2**31))
+
+
+def truncnorm_lower(loc,scale,size,rng=None,out=None):
+    """
+    Normal variates with mean loc and standard deviation scale truncated to (0,inf),
+    the same distribution as scipy truncnorm.rvs(-loc/scale,inf,loc,scale) without the
+    per-call argument checking and frozen distribution setup
+
+    Input
+    ------
+    loc: mean of the untruncated normal
+    scale: standard deviation of the untruncated normal
+    size: number of variates
+    rng: the random source, see get_rng
+    out: optional (size,) float array to draw into, it is returned
+
+    Output
+    ------
+    array: the (size,) variates
+    """
+    rng = get_rng(rng)
+    if out is None:
+        out = np.empty(size)
+    else: pass
+    if size == 0:
+        return out
+    else: pass
+
+    # Inverse CDF of the upper tail, the standard variate z > a = -loc/scale has
+    # P(Z > z) = u*P(Z > a) for u uniform in (0,1]. Working with the upper tail keeps
+    # the precision since P(Z > a) is close to 1 for the specs of the simulation
+    out[:] = rng.random(size)
+    np.subtract(1,out,out=out)
+    np.multiply(out,ndtr(loc/scale),out=out)
+    ndtri(out,out=out)
+    np.multiply(out,-scale,out=out)
+    np.add(out,loc,out=out)
+    # Round-off at the tail can give a tiny negative value
+    np.maximum(out,0,out=out)
+    return out
@@ -0,0 +1,79 @@
+import heapq
+import numpy as np
+
+
+################################################
+#                                              #
+#               Event scheduler                #
+#                                              #
+################################################
+
+
+class EventQueue:
+    """
+    Scheduler of the future transitions (recovery or death) keyed on their time stamps
+    
+    Each push is kept as a run of events sorted by time, and the runs are stored in a
+    heap keyed on their earliest time stamp. Popping the due events only touches the
+    runs holding due events, O(log n_runs) each, while the events themselves stay in
+    numpy arrays, hence millions of pending events are cheap
+    """
+    
+    def __init__(self):
+        # heap of (earliest time, push counter, sorted times, indices)
+        self._runs = []
+        self._counter = 0
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    def push(self,idx,fut_time):
+        """
+        Schedule the events of the subjects idx at the time stamps fut_time
+        
+        Input
+        ------
+        idx: the subjects' indices
+        fut_time: the time stamps of the events, the same shape as idx
+        """
+        idx = np.asarray(idx).ravel()
+        fut_time = np.asarray(fut_time,dtype=float).ravel()
+        if idx.size == 0:
+            return
+        else: pass
+        order = np.argsort(fut_time,kind='stable')
+        fut_time,idx = fut_time[order],idx[order]
+        # the counter breaks the tie between runs, arrays are never compared
+        heapq.heappush(self._runs,(fut_time[0],self._counter,fut_time,idx))
+        self._counter += 1
+        self._size += idx.size
+    
+    def pop(self,current_time):
+        """
+        Remove and return the indices of the events earlier than current_time
+        """
+        due = []
+        while self._runs and self._runs[0][0] < current_time:
+            _,counter,fut_time,idx = heapq.heappop(self._runs)
+            n = np.searchsorted(fut_time,current_time,side='left')
+            due.append(idx[:n])
+            if n < idx.size:
+                # put the rest of the run back
+                heapq.heappush(self._runs,(fut_time[n],counter,fut_time[n:],idx[n:]))
+            else: pass
+        if len(due) == 0:
+            return np.array([],dtype=np.int64)
+        else: pass
+        due = np.concatenate(due)
+        self._size -= due.size
+        return due
+    
+    def next_time(self):
+        """
+        The time stamp of the next pending event, inf if nothing is scheduled
+        """
+        if self._runs:
+            return self._runs[0][0]
+        else:
+            return np.inf
@@ -0,0 +1,225 @@
+import os,json
+import numpy as np
+
+
+################################################
+#                                              #
+#            On-disk trajectory store          #
+#                                              #
+################################################
+
+
+def frame_dtype(num):
+    """
+    Layout of a single frame with num subjects, the status followed by the positions
+    """
+    return np.dtype([('status',np.int8,(num,)),('pos',np.float32,(2,num))])
+
+
+def store_files(prefix):
+    """
+    File names of the trajectory store with the given prefix
+    
+    Output
+    ------
+    tuple: the header (json), the raw frames and the time stamp of each frame
+    """
+    return prefix+'_traj.json',prefix+'_traj.bin',prefix+'_traj_time.bin'
+
+
+class TrajectoryWriter:
+    """
+    Streaming writer of the fixed-size frames. The frames are buffered in a preallocated
+    chunk and appended to the raw file whenever the chunk is full, hence the memory is
+    bounded whatever the number of steps and a crashed run leaves the flushed frames
+    readable
+    
+    Input
+    ------
+    prefix: path prefix of the store files, see store_files
+    num: number of subjects in every frame
+    codes: dict of the status names and their codes, eg. {'Ill':1,...}
+    chunk: number of frames buffered before flushing to the disk
+    frames: keep the first frames of an existing store and append after them, eg. when
+            a run is resumed from a checkpoint, the default 0 starts a new store
+    """
+    
+    def __init__(self,prefix,num,codes,chunk=64,frames=0):
+        self.num = num
+        self.codes = dict(codes)
+        header,data,time = store_files(prefix)
+        if frames > 0 and not has_store(prefix):
+            raise ValueError('Appending after %d frames but the trajectory store '%frames+prefix
+                             +' is missing, the run should be resumed with the disease_name '
+                             'of the run that wrote the checkpoint')
+        else: pass
+        with open(header,'w') as f:
+            json.dump({'num':num,'codes':self.codes},f)
+        if frames == 0:
+            self._data = open(data,'wb')
+            self._time = open(time,'wb')
+        else:
+            # drop the frames written after the checkpoint
+            self._data = open(data,'r+b')
+            self._data.truncate(frames*frame_dtype(num).itemsize)
+            self._data.seek(0,os.SEEK_END)
+            self._time = open(time,'r+b')
+            self._time.truncate(frames*8)
+            self._time.seek(0,os.SEEK_END)
+        # preallocated chunk of frames
+        self._frames = np.zeros(chunk,dtype=frame_dtype(num))
+        self._stamps = np.zeros(chunk)
+        self._count = 0
+        self.frames_written = frames
+    
+    def write(self,status,pos,time):
+        """
+        Buffer a frame given by the (num,) status and (2,num) position arrays
+        """
+        frame = self._frames[self._count]
+        frame['status'] = status
+        frame['pos'] = pos
+        self._push(time)
+    
+    def write_groups(self,groups,codes,time):
+        """
+        Buffer a frame given by the position arrays of each status, eg. the
+        xi,xh,xr,xd of the tuple engine with their codes
+        """
+        frame = self._frames[self._count]
+        start = 0
+        for pos,code in zip(groups,codes):
+            end = start+len(pos[0])
+            frame['status'][start:end] = code
+            frame['pos'][:,start:end] = pos
+            start = end
+        if start != self.num:
+            raise ValueError('The frame has %d subjects but the store expects %d'%(start,self.num))
+        else: pass
+        self._push(time)
+    
+    def _push(self,time):
+        self._stamps[self._count] = time
+        self._count += 1
+        if self._count == len(self._frames):
+            self.flush()
+        else: pass
+    
+    def flush(self):
+        """
+        Append the buffered frames to the disk, the time stamps are written after
+        the frames so that every indexed frame is complete
+        """
+        if self._count == 0:
+            return
+        else: pass
+        self._frames[:self._count].tofile(self._data)
+        self._data.flush()
+        self._stamps[:self._count].tofile(self._time)
+        self._time.flush()
+        self.frames_written += self._count
+        self._count = 0
+    
+    def close(self):
+        if self._data.closed:
+            return
+        else: pass
+        self.flush()
+        self._data.close()
+        self._time.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+
+
+class Frame:
+    """
+    A single frame of the trajectory store, the legacy keys of _fullout, eg.
+    'IllPosition', are supported for the positions. The velocities are not stored,
+    the '*Velocity' keys of _fullout are not available
+    
+    status: (N,) int8 view of the subjects' status
+    pos: (2,N) float32 view of the subjects' positions
+    time: the time stamp of this frame
+    """
+    
+    def __init__(self,status,pos,time,codes):
+        self.status = status
+        self.pos = pos
+        self.time = time
+        self.codes = codes
+    
+    def keys(self):
+        return [name+'Position' for name in self.codes]
+    
+    def __getitem__(self,key):
+        name = key[:-len('Position')] if key.endswith('Position') else None
+        if str(key).endswith('Velocity'):
+            raise KeyError(str(key)+' is not in the trajectory store, the velocities are '
+                           'only kept in the _fullout of the runs without stream')
+        elif name not in self.codes:
+            raise KeyError(str(key)+' is not in the trajectory store, available keys are '
+                           +str(self.keys()))
+        else: pass
+        return self.pos[:,self.status == self.codes[name]]
+
+
+class TrajectoryReader:
+    """
+    Lazy random-access frames of the trajectory store. The arrays are np.memmap views,
+    frames[s] returns a Frame and frames[a:b] another TrajectoryReader without copying,
+    only the touched frames are read from the disk
+    
+    status: (n_frames,N) int8 array
+    pos: (n_frames,2,N) float32 array
+    time: (n_frames,) time stamps
+    codes: dict of the status names and their codes
+    """
+    
+    def __init__(self,status,pos,time,codes):
+        self.status = status
+        self.pos = pos
+        self.time = time
+        self.codes = codes
+    
+    @classmethod
+    def open(cls,prefix):
+        """
+        Open the trajectory store with the given path prefix, see store_files. The frames
+        of an unfinished run are readable up to the last completely flushed one
+        """
+        header,data,time = store_files(prefix)
+        with open(header) as f:
+            info = json.load(f)
+        dtype = frame_dtype(info['num'])
+        n_frames = min(os.path.getsize(data)//dtype.itemsize,os.path.getsize(time)//8)
+        if n_frames == 0:
+            frames = np.zeros(0,dtype=dtype)
+            stamps = np.zeros(0)
+        else:
+            frames = np.memmap(data,dtype=dtype,mode='r',shape=(n_frames,))
+            stamps = np.memmap(time,dtype=np.float64,mode='r',shape=(n_frames,))
+        return cls(frames['status'],frames['pos'],stamps,info['codes'])
+    
+    def __len__(self):
+        return len(self.time)
+    
+    def __getitem__(self,s):
+        if isinstance(s,slice):
+            return TrajectoryReader(self.status[s],self.pos[s],self.time[s],self.codes)
+        else:
+            return Frame(self.status[s],self.pos[s],self.time[s],self.codes)
+    
+    def __iter__(self):
+        for s in range(len(self)):
+            yield self[s]
+
+
+def has_store(prefix):
+    """
+    Does the trajectory store with the given prefix exist
+    """
+    return all(os.path.isfile(f) for f in store_files(prefix))